@@ -1,639 +1,515 @@
 # # Constructing a consistent US County Per Capita Income Dataset 1969-2017
-# 
-# This notebook builds a cleaned geopackage for use in the inequality chapter of the book.  It does so by carrying out a number of data processing steps to:
-# 
+#
+# This script builds a cleaned geopackage for use in the inequality chapter of the book.  It does so by carrying out a number of data processing steps to:
+#
 # - Generalize the boundaries of the county shapefile to faciltate processing
 # - Joining income attributes with geometries
 # - Handling the birth and deaths of counties over the time series
+#
+# It expects the county shapefile (`tl_2019_us_county/`) and `CAINC1.zip` from
+# the data archive (see README) in the working directory and is run as:
+#
+#     python us_county_income_clean.py
+#
+# County shapes are read and simplified once. Every state is then joined with
+# its income records independently, and only the states whose inputs changed
+# are joined again: stage results are cached (see "Build stages" below), so a
+# rebuild only redoes the work affected by what changed.
+#
+# Income values are read once as floats, with BEA's `(NA)` as missing, and
+# stages hand their tables to each other as GeoParquet (or, with
+# `--handoff memory`, without touching the disk at all). `--benchmark`
+# times both against the shapefile round trips the script used to do.
 
-
-import pandas
-from zipfile import ZipFile
 import glob
-from urllib.request import urlopen
-from io import BytesIO
-import fiona.io
-import geopandas as gpd
+import hashlib
+import inspect
+import os
+import pickle
+from zipfile import ZipFile
+
+import fiona
+import geopandas
+import numpy
 import pandas
-import requests
+import pyarrow
 import topojson as tp
-get_ipython().system('pip install topojson')
-
-"""
-# Not needed because of git-lfs problems, just use raw file
-url = 'https://github.com/gdsbook/data_archive/raw/master/us_county_income/tl_2019_us_county.zip'
-
-response = requests.get(url)
-data_bytes = response.content
-
-with fiona.io.ZipMemoryFile(data_bytes) as zip_memory_file:
-    with zip_memory_file.open('tl_2019_us_county.shp') as collection:
-        gdf = gpd.GeoDataFrame.from_features(collection, crs=collection.crs)
-#gdf.to_file('tl_2019_us_county.shp')
-"""
-
-with fiona.open('tl_2019_us_county/tl_2019_us_county.shp') as collection:
-        gdf = gpd.GeoDataFrame.from_features(collection, crs=collection.crs)
-
-topo = tp.Topology(gdf, prequantize=False)
-gdf_simplified = topo.toposimplify(5).to_gdf()
-gdf_simplified.to_file('tl_2019_us_county.shp')
-
-
-"""
-Not needed, just use raw file
-caincurl = 'https://github.com/gdsbook/data_archive/raw/master/us_county_income/CAINC1.zip'
-with urlopen(caincurl) as zipresp:
-    with ZipFile(BytesIO(zipresp.read())) as zf:
-        zf.extractall()
-"""
-
-with ZipFile('CAINC1.zip') as zf:
-    zf.extractall()
-        
-        
-csv_files = glob.glob("*.csv")
-data = pandas.read_csv('CAINC1__ALL_STATES_1969_2017.csv', encoding='latin-1', 
-                      skipfooter=3, engine='python')
-
-virginia = data[data.GeoFIPS.str.contains('\"51')] # select virginia
-virginia.to_csv('virginia.csv')
-
-
-# fips codes source: https://www.nrcs.usda.gov/wps/portal/nrcs/detail/?cid=nrcs143_013696
-fips = """Alabama 	AL 	01
-Alaska 	AK 	02
-Arizona 	AZ 	04
-Arkansas 	AR 	05
-California 	CA 	06
-Colorado 	CO 	08
-Connecticut 	CT 	09
-Delaware 	DE 	10
-Florida 	FL 	12
-Georgia 	GA 	13
-Hawaii 	HI 	15
-Idaho 	ID 	16
-Illinois 	IL 	17
-Indiana 	IN 	18
-Iowa 	IA 	19
-Kansas 	KS 	20
-Kentucky 	KY 	21
-Louisiana 	LA 	22
-Maine 	ME 	23
-Maryland 	MD 	24
-Massachusetts 	MA 	25
-Michigan 	MI 	26
-Minnesota 	MN 	27
-Mississippi 	MS 	28
-Missouri 	MO 	29
-Montana 	MT 	30
-Nebraska 	NE 	31
-Nevada 	NV 	32
-New Hampshire 	NH 	33
-New Jersey 	NJ 	34
-New Mexico 	NM 	35
-New York 	NY 	36
-North Carolina 	NC 	37
-North Dakota 	ND 	38
-Ohio 	OH 	39
-Oklahoma 	OK 	40
-Oregon 	OR 	41
-Pennsylvania 	PA 	42
-Rhode Island 	RI 	44
-South Carolina 	SC 	45
-South Dakota 	SD 	46
-Tennessee 	TN 	47
-Texas 	TX 	48
-Utah 	UT 	49
-Vermont 	VT 	50
-Virginia 	VA 	51
-Washington 	WA 	53
-West Virginia 	WV 	54
-Wisconsin 	WI 	55
-Wyoming 	WY 	56
-American Samoa 	AS 	60
-Guam 	GU 	66
-Northern Mariana Islands 	MP 	69
-Puerto Rico 	PR 	72
-Virgin Islands 	VI 	78"""
-
-
-fips_df = pandas.DataFrame([fip.split("\t") for fip in fips.split("\n")])
-fips_df.columns=["State", "Abbreviation", 'FIPS']
-omit_fips = [" \""+str(fip) for fip in ['02', 15, 60, 66, 69, 72, 78, 90, 91, 92, 93, 94, 95, 96, 97, 98]]
-
-small = data.copy()
-for omit in omit_fips:
-    small = small[~small.GeoFIPS.str.contains(omit)]
-    
-geofips = set(code[:4] for code in small.GeoFIPS.values)
-
-for fip in geofips:
-    sdf = small[small.GeoFIPS.str.contains(fip)]
-    sdf.to_csv(fip[2:]+".csv")
-
-# We are done as all the csv files have been extracted.
-
-# Read remote shapefile with county geometries
-
-gdf = geopandas.read_file("tl_2019_us_county.shp")
-
-#State Specific Data Frames
-csv_files = glob.glob("??.csv")
-csv_files.sort()
-csv_files.pop(0) # kick out US
-
-mismatch = []
-gdfs = []
-#for csv_file in csv_files[:1]:
-for csv_file in csv_files:
-
-    #print(csv_file)
-    csv = pandas.read_csv(csv_file)
-    st = csv_file[:2]
-    st_gdf = gdf[gdf.STATEFP==st]
-    csv = csv.iloc[3:] # kick out the state level records
-    nc, kc = csv.shape
-    if nc/3 != st_gdf.shape[0]:
-        mismatch.append(st)
-        print(st)
-    else:
-        csv['GeoFIPS'] = [fip.strip().replace("\"", "") for fip in csv.GeoFIPS]
-        csv['GEOID'] = csv.GeoFIPS.astype(str)
-        merged_gdf = st_gdf.merge(csv, on='GEOID')
-        gdfs.append(merged_gdf)
-        
-gdf = pandas.concat(gdfs)
-
-#only get columns of dataframe that are numeric for years 
-gdf_columns = gdf.columns.to_list()
-years = []
-for col in gdf_columns:
-    if col.isnumeric() == True:
-        years.append(col)
-        
-dtypes = list(zip(years,[gdf[year].dtype for year in years]))
-
-# ## Issues
-# 
-# 1. Virginia
-# 2. Wisconsin
-# 3. Object data types for 1969-2001
-
-gdf.to_file('pcincome0.shp')
-
+from pyarrow import feather
+
+
+COUNTIES = 'tl_2019_us_county/tl_2019_us_county.shp'
+INCOME = 'CAINC1.zip'
+INCOME_CSV = 'CAINC1__ALL_STATES_1969_2017.csv'
+
+years = [str(year) for year in range(1969, 2018)]
+
+# US total, Alaska, Hawaii, territories and BEA regions
+omit_fips = ['00', '02', '15', '60', '66', '69', '72', '78',
+             '90', '91', '92', '93', '94', '95', '96', '97', '98']
+
+
+def clean_fips(fips):
+    """
+    Strip the padding and quotes BEA puts around FIPS codes (` "01001"`).
+    """
+    return fips.str.strip().str.replace('"', '', regex=False)
+
+
+def load_counties(path=COUNTIES, tolerance=5):
+    """
+    County geometries, generalized on a shared topology so neighbours still
+    meet after simplification.
+    """
+    with fiona.open(path) as collection:
+        gdf = geopandas.GeoDataFrame.from_features(collection, crs=collection.crs)
+    topo = tp.Topology(gdf, prequantize=False)
+    return topo.toposimplify(tolerance).to_gdf()
+
+
+def load_income(path=INCOME, member=INCOME_CSV):
+    """
+    County income records, without the state totals and omitted states.
+
+    Year columns are floats, with values BEA does not report as NaN.
+    """
+    with ZipFile(path) as zf:
+        with zf.open(member) as f:
+            data = pandas.read_csv(f, encoding='latin-1', skipfooter=3,
+                                   engine='python', na_values=['(NA)'],
+                                   dtype={year: 'float64' for year in years})
+    data['GeoFIPS'] = clean_fips(data.GeoFIPS)
+    data['GEOID'] = data.GeoFIPS
+    state = data.GEOID.str[:2]
+    return data[~data.GEOID.str.endswith('000') & ~state.isin(omit_fips)]
+
+
+def merge_state(records, st_gdf, exact=True):
+    """
+    Join a state's income records (three lines per county) to its counties.
+    If `exact`, return None unless they line up one to one; otherwise keep
+    the counties that have records.
+    """
+    if exact and len(records) / 3 != len(st_gdf):
+        return None
+    return st_gdf.merge(records, on='GEOID')
+
+
+# # County combinations
+#
+# BEA does not report every county of the 2019 boundaries on its own. The
+# places it reports together are listed in `combinations`, one rule per
+# combined area, and are dissolved into a single shape and a single set of
+# income records in one pass over the whole country.
+#
 # ## Virginia independent cities
-# 
+#
 # Reference https://en.wikipedia.org/wiki/Independent_city_(United_States)
-# 
-# > In the United States, an independent city is a city that is not in the territory of any county or counties with exceptions noted below. Of the 41 independent U.S. cities,[1] 38 are in Virginia, whose state constitution makes them a special case. The three independent cities outside Virginia are Baltimore, Maryland; St. Louis, Missouri; and Carson City, Nevada. The U.S. Census Bureau uses counties as its base unit for presentation of statistical information, and treats independent cities as county equivalents for those purposes. The most populous of them is Baltimore, Maryland. 
-# 
-# 
+#
+# > In the United States, an independent city is a city that is not in the territory of any county or counties with exceptions noted below. Of the 41 independent U.S. cities,[1] 38 are in Virginia, whose state constitution makes them a special case. The three independent cities outside Virginia are Baltimore, Maryland; St. Louis, Missouri; and Carson City, Nevada. The U.S. Census Bureau uses counties as its base unit for presentation of statistical information, and treats independent cities as county equivalents for those purposes. The most populous of them is Baltimore, Maryland.
+#
+#
 # ### From BEA Income Data:
 # > Virginia combination areas consist of one or two independent cities with 1980 populations of less than 100,000 combined with an adjacent county. The county name appears first, followed by the city name(s). Separate estimates for the jurisdictions making up the combination area are not available. Bedford County, VA includes the independent city of Bedford for all years.
-# 
+#
 # ### Virginia
 # > The Commonwealth of Virginia is divided into 95 counties, along with 38 independent cities that are considered county-equivalents for census purposes. The map in this article, taken from the official United States Census Bureau site, includes Clifton Forge and Bedford as independent cities. This reflected the political reality at the time of the 2000 Census. However, both have since chosen to revert to town status. In Virginia, cities are co-equal levels of government to counties, but towns are part of counties. For some counties, for statistical purposes, the Bureau of Economic Analysis combines any independent cities with the county that it was once part of (before the legislation creating independent cities took place in 1871).
-# 
+#
 # [Source](https://en.wikipedia.org/wiki/List_of_cities_and_counties_in_Virginia)
-# 
+#
 # ### Approach
-# 
+#
 # Dissolve boundaries of independent cities that BEA does not disclose values for with their adjacent county.
-
-csv = pandas.read_csv('51.csv')
-csv['GeoFIPS'] = [fip.strip().replace("\"", "") for fip in csv.GeoFIPS]
-gdf = geopandas.read_file('tl_2019_us_county.shp')
-
-
-# gdf = geopandas.read_file("zip:tl_2019_us_county.zip!tl_2019_us_county.shp")
-# zipfile = "zip:tl_2019_us_county.zip!tl_2019_us_county.shp"
-
-virginia_gdf = gdf[gdf.STATEFP=="51"]
-data = csv
-
-data['GEOID'] = data.GeoFIPS
-
-# ## gdf records missing income values
-
-#data = data[data.LineCode==3]
-merged_gdf = virginia_gdf.merge(data, on='GEOID')
-merged_gdf.shape[0]/3
-matched_names = set(merged_gdf.NAMELSAD)
-
-missing_gdf = virginia_gdf[~virginia_gdf.GEOID.isin(merged_gdf.GEOID)]
-missing_names = set(missing_gdf.NAMELSAD)
-
-#names = missing_gdf.NAME
-names = missing_gdf.NAMELSAD
-
-virginia_income = data[data.GeoName.str.contains(", VA")]
-
-geonames = pandas.unique(virginia_income.GeoName)
-
-
-class Combination:
-    def __init__(self, label):
-        n_commas = label.count(",")
-        self.label = label
-        self.n_commas = n_commas
-        if "Fairfax City" in label:
-            label = label.replace('Fairfax City', 'Fairfax')
-        if n_commas == 1:
-            if "Bedford" in label:
-                self.county = 'Bedford'
-                self.cities = []
-            else:
-                words = label.split("+")
-                county = words[0].strip()
-                self.county = county
-                self.cities = [words[-1].split(",")[0].strip()+" city"]
-        elif n_commas == 2:
-            words = label.split(",")
-            self.county = words[0].strip()
-            cities = words[1]
-            cities = cities.split("+")
-            
-            self.cities = [city.strip()+" city" for city in cities]
-        else:
-            print('Bad label: ', label)
-        self.county = self.county + " County"
-        self.NAMELSAD = self.label
-        
-combinations_0 = [name for name in geonames if "VA*" in name]
-combinations = [Combination(c) for c in combinations_0]
-
-c0 = combinations[0]
-
-matches = {}
-for name in names:
-    hits = []
-    matches[name] = []
-    if "city" in name:
-        hits = [comb for comb in combinations if name in comb.cities]
-    else:
-        hits = [comb for comb in combinations if name == comb.county]
-    if hits:
-        matches[name] = hits[0].label
-    
-
-# ## Match combinations to rows of df
-
-for combination in combinations:
-    print("label: ",combination.label)
-    comb_names = [combination.county]+combination.cities
-    print(comb_names)
-
-merged_dfs = []
-geoids = []
-for combination in combinations:
-    places = combination.cities + [combination.county]
-    print(places)
-    rows = virginia_gdf[virginia_gdf.NAMELSAD.isin(places)]
-    
-    if len(rows) != len(places):
-        print('missed:', places)
-    #d_df = rows.dissolve(by='STATEFP')
-    rd = rows.dissolve(by='STATEFP').head()
-    rd['NAMELSAD']= combination.label
-    geoid = virginia_income[virginia_income.GeoName==combination.label].GEOID.values[0]
-    rd['GEOID'] = geoid
-    merged_dfs.append(rd)
-    
-
-dissolved = pandas.concat(merged_dfs)
-d_merge = dissolved.merge(virginia_income, on='GEOID')
-final_gdf = pandas.concat([merged_gdf, d_merge])
-final_gdf['1979'] = final_gdf['1979'].astype(int)
-final_gdf.STATEFP='51'
-final_gdf[final_gdf.NAME=='Charlottesville']
-
-# ## Reverse Matching
-# 
-# Which income records do not match a record in the shapefile
-
-virginia_gdf = gdf[gdf.STATEFP=="51"]
-
-#data = data[data.LineCode==3]
-merged_df = data.merge(virginia_gdf, on='GEOID')
-
-missing_df = data[~data.GEOID.isin(merged_df.GEOID)]
-#~virginia_gdf.GEOID.isin(merged_gdf.GEOID)
-
-pcincome_gdf = geopandas.read_file('pcincome0.shp')
-common = set(pcincome_gdf.columns).intersection(final_gdf.columns)
-
-us = pcincome_gdf[common]
-va = final_gdf[common]
-va.reset_index(inplace=True)
-dup = va[va[["NAME", "GEOID", "1969"]].duplicated()]
-
-va = va.drop(dup.index)
-usva = pandas.concat([us,va])
-
-years = [str(year) for year in range(1969,2018)]
-dtypes = list(zip(years,[usva[year].dtype for year in years]))
-
-usva.to_file('usva.shp')
-
-namedf = usva[['GeoName', 'STATEFP', '1969']]
-
+#
 # ## Wisconsin
-
-csv = pandas.read_csv('55.csv')
-csv = csv.replace('(NA)', 0)
-
-menominee = csv[csv.GeoName.str.match('Menominee, WI*')].replace('(NA)', 0)
-shawano = csv[csv.GeoName.str.match('Shawano, WI*')].replace('(NA)', 0)
-combined  = csv[csv.GeoName.str.contains('includes Menominee')].replace('(NA)', 0)
-
-menominee[years] = menominee[years].astype(int)
-shawano[years] = shawano[years].astype(int)
-combined[years] = combined[years].astype(int)
-
-cindex = [ combined.columns.values.tolist().index(y) for y in years]
-
-for c,y in zip(cindex,years):
-    #print(menominee[y].dtype)
-    #print(shawano[y].dtype)
-    #print(combined[y].dtype)
-    combined.iloc[0,c] = menominee.iloc[0,c] + shawano.iloc[0,c]
-    try:
-        combined.iloc[2,c] = int(combined.iloc[0,c]*1000/ combined.iloc[1,c]) # creates a float NaN on the 3rd value
-    except ValueError:
-        combined.iloc[2,c] = combined.iloc[0,c]*1000/ combined.iloc[1,c]
-    csv.iloc[combined.index[0],c] = combined.iloc[0,c]
-    csv.iloc[combined.index[1],c] = combined.iloc[1,c]
-    csv.iloc[combined.index[2],c] = combined.iloc[2,c]
-
-csv.fillna(0,inplace=True) # get rid of float NaNs
-
-# ## Drop shawano and menomiee from csv
-
-drop_ids = menominee.index.to_list() + shawano.index.to_list()
-csv = csv.drop(drop_ids)
-csv[years] = csv[years].astype(int)
-
-for year in years:
-    print(csv[str(year)].dtype)
-    
-# ## Dissolve shawano and menominee geometries in gdf
-# 
-# dissolve
-# and assign geofips
-
-
-gdf = geopandas.read_file("tl_2019_us_county.shp")
-wisconsin_gdf = gdf[gdf.STATEFP=="55"]
-
-combined = wisconsin_gdf[wisconsin_gdf.COUNTYFP.isin(['115', '078'])].dissolve(by='STATEFP')
-combined['NAME'] = "Shawano+Menominee"
-combined['NAMELSAD'] = "Shawano+Menominee Counties"
-combined['GEOID'] = '55901'
-
-wisc0 = wisconsin_gdf[~wisconsin_gdf.COUNTYFP.isin(['115', '078'])] # codes for Shawano & Menominee
-wisc1 = pandas.concat([wisc0, combined])
-
-# ## Merge gdf and csv
-
-csv['GeoFIPS'] = [fip.strip().replace("\"", "") for fip in csv.GeoFIPS]
-wisc1.STATEFP='55'
-data = csv
-data['GEOID'] = data.GeoFIPS
-
-# ## gdf records missing income values
-
-#data = data[data.LineCode==3]
-merged_gdf = wisc1.merge(data, on='GEOID')
-
-matched_names = set(merged_gdf.NAMELSAD)
-missing_gdf = wisc1[~wisc1.GEOID.isin(merged_gdf.GEOID)]
-missing_names = set(missing_gdf.NAMELSAD)
-usva = geopandas.read_file('usva.shp')
-
-us_no_wisc = usva[usva.STATEFP!='55']
-
-us = pandas.concat([merged_gdf, us_no_wisc])
-
-for y in years:
-    print(us[str(y)].dtype)
-
-
-us.to_file('usincome.shp')
-
-# # Other
-# 
+#
+# BEA reports Shawano (includes Menominee) next to the two counties, which
+# it reports separately from 1989.
+#
 # ## Issue from BEA Income Data:
 # <LI>*&nbsp;Cibola, NM was separated from Valencia in June 1981, but in these estimates, Valencia includes Cibola through the end of 1981.</LI>
 # <LI>*&nbsp;La Paz County, AZ was separated from Yuma County on January 1, 1983. The Yuma, AZ MSA contains the area that became La Paz County, AZ through 1982 and excludes it beginning with 1983.</LI>
-# 
+#
 # <LI>*&nbsp;Broomfield County, CO, was created from parts of Adams, Boulder, Jefferson, and Weld counties effective November 15, 2001. Estimates for Broomfield county begin with 2002.</LI>
-# 
-# 
+#
+#
 # ### Approach
-# 
+#
 # - combine Cibola NM with Valencia for 1981-2017
 # - combine La Paz County AZ with Yuma for 1983-2017
 # - combine Broomfield County with Boulder CO all years (<2002 Boulder, >2002 Boulder+Broomfield)
-# 
-# 
-
-# NM
-
-csv = pandas.read_csv('35.csv')
-csv = csv.replace('(NA)', 0)
-
-cibola = csv[csv.GeoName.str.startswith('Cibola')]
-valencia = csv[csv.GeoName.str.startswith('Valencia')]
-
-combined = cibola.copy()
-cibola[years] = cibola[years].astype(int)
-valencia[years] = valencia[years].astype(int)
-combined[years] = combined[years].astype(int)
-
-cindex = [ combined.columns.values.tolist().index(y) for y in years]
-
-for c,y in zip(cindex,years):
-    #print(menominee[y].dtype)
-    #print(shawano[y].dtype)
-    #print(combined[y].dtype)
-    
-    
-    combined.iloc[0,c] = valencia.iloc[0,c] + cibola.iloc[0,c]
-    combined.iloc[1,c] = valencia.iloc[1,c] + cibola.iloc[1,c]
-    combined.iloc[2,c] = int(combined.iloc[0,c]*1000/ combined.iloc[1,c])
-    #csv.iloc[219,c] = combined.iloc[0,c]
-    #csv.iloc[220,c] = combined.iloc[1,c]
-    #csv.iloc[221,c] = combined.iloc[2,c]
-
-
-# ## Drop Cibola and Valencia and Update Combined Fields
-
-drop_ids = cibola.index.to_list() + valencia.index.to_list()
-csv = csv.drop(drop_ids)
-combined['GeoName'] = 'Cibola+Valencia'
-combined['GeoFIPS'] = '"35061"'
-combined = combined[csv.columns]
-csv = pandas.concat([csv, combined])
-
-gdf = geopandas.read_file("tl_2019_us_county.shp")
-
-nm_gdf = gdf[gdf.STATEFP=="35"]
-nm_gdf[nm_gdf.NAME.isin(['Valencia', 'Cibola'])]
-
-combined = nm_gdf[nm_gdf.NAME.isin(['Valencia', 'Cibola'])].dissolve(by='STATEFP')
-combined['NAME'] = 'Cibola+Valencia'
-combined['NAMELSAD'] = 'Cibola+Valencia Counties'
-combined['STATEFP'] = 35
-combined['GEOID'] =  '35061' # Valencia
-
-
-nm0 = nm_gdf[~nm_gdf.COUNTYFP.isin(['006', '061'])]
-nm1 = pandas.concat([nm0, combined])
-
-csv['GeoFIPS'] = [fip.strip().replace("\"", "") for fip in csv.GeoFIPS]
-data = csv
-data['GEOID'] = data.GeoFIPS
-
-merged_gdf = nm1.merge(data, on='GEOID')
-us = geopandas.read_file('usincome.shp')
-us1 = pandas.concat([us[us.STATEFP!='35'], merged_gdf])
-
-
-# ##  Arizona
-# 
-# - combine La Paz County AZ with Yuma for 1983-2017
-# 
-
-csv = pandas.read_csv('04.csv')
-csv = csv.replace('(NA)', 0)
-
-la_paz = csv[csv.GeoName.str.startswith('La Paz')]
-yuma = csv[csv.GeoName.str.startswith('Yuma')]
-combined = yuma.copy()
-la_paz[years] = la_paz[years].astype(int)
-yuma[years] = yuma[years].astype(int)
-combined[years] = combined[years].astype(int)
-
-cindex = [ combined.columns.values.tolist().index(y) for y in years]
-
-for c,y in zip(cindex,years):
-    #print(menominee[y].dtype)
-    #print(shawano[y].dtype)
-    #print(combined[y].dtype)
-    combined.iloc[0,c] = la_paz.iloc[0,c] + yuma.iloc[0,c]
-    combined.iloc[1,c] = la_paz.iloc[1,c] + yuma.iloc[1,c]
-    combined.iloc[2,c] = int(combined.iloc[0,c]*1000/ combined.iloc[1,c])
-
-drop_ids = la_paz.index.to_list() + yuma.index.to_list()
-csv = csv.drop(drop_ids)
-combined['GeoName'] = 'Yuma+La Paz'
-combined['GeoFIPS'] = '"04027"'
-combined['STATEFP'] = 4
-combined = combined[csv.columns]
-
-csv = pandas.concat([csv, combined])
-
-gdf = geopandas.read_file("tl_2019_us_county.shp")
-az_gdf = gdf[gdf.STATEFP=='04']
-
-combined = az_gdf[az_gdf.COUNTYFP.isin(['027', '012'])].dissolve(by='STATEFP')
-combined['NAME']= "Yuma+La Paz"
-combined['NAMELSAD'] = "Yuma+La Paz Counties"
-
-az0 = az_gdf[~az_gdf.COUNTYFP.isin(['027', '012'])]
-az1 = pandas.concat([az0, combined])
-
-
-# ## Merge gdf and csv
-
-csv['GeoFIPS'] = [fip.strip().replace("\"", "") for fip in csv.GeoFIPS]
-data['GEOID'] = data.GeoFIPS
-
-merged_gdf = az1.merge(data, on='GEOID')
-merged_gdf['STATEFP'] = '04'
-
-us2 = pandas.concat([us1[us1.STATEFP!='04'], merged_gdf])
-
-us2[us2.STATEFP=='04'].shape
-
-# ## Colorado
-# 
-# - combine Broomfield County with Boulder CO all years (<2002 Boulder, >2002 Boulder+Broomfield)
-# 
-
-csv = pandas.read_csv('08.csv')
-
-csv = csv.replace('(NA)', 0)
-boulder = csv[csv.GeoName.str.startswith('Boulder')]
-broomfield = csv[csv.GeoName.str.startswith('Broom')]
-combined = boulder.copy()
-boulder[years] = boulder[years].astype(int)
-broomfield[years] = broomfield[years].astype(int)
-combined[years] = combined[years].astype(int)
-
-
-cindex = [ combined.columns.values.tolist().index(y) for y in years]
-
-for c,y in zip(cindex,years):
-    #print(menominee[y].dtype)
-    #print(shawano[y].dtype)
-    #print(combined[y].dtype)
-    combined.iloc[0,c] = boulder.iloc[0,c] + broomfield.iloc[0,c]
-    combined.iloc[1,c] = boulder.iloc[1,c] + broomfield.iloc[1,c]
-    combined.iloc[2,c] = int(combined.iloc[0,c]*1000/ combined.iloc[1,c])
-    
-drop_ids = boulder.index.to_list() + broomfield.index.to_list()
-csv = csv.drop(drop_ids)
-csv[years] = csv[years].astype(int)
-
-combined['GeoName'] = 'Boulder+Broomfield'
-combined['GeoFIPS'] = '"08013"'
-combined = combined[csv.columns]
-
-csv = pandas.concat([csv, combined])
-
-gdf = geopandas.read_file("tl_2019_us_county.shp")
-
-co_gdf = gdf[gdf.STATEFP=='08']
-
-combined = co_gdf[co_gdf.COUNTYFP.isin(['013', '014'])].dissolve(by='STATEFP')
-combined['NAME'] = "Boulder+Bloomfield"
-combined['NAMELSAD'] = "Boulder+Bloomfield Counties"
-combined['GEOID'] = '08013'
-
-co0 = co_gdf[~co_gdf.COUNTYFP.isin(['013', '014'])]
-co1 = pandas.concat([co0, combined])
-
-csv['GeoFIPS'] = [fip.strip().replace("\"", "") for fip in csv.GeoFIPS]
-data = csv
-data['GEOID'] = data.GeoFIPS
-
-merged = co1.merge(data, on='GEOID')
-merged['STATEFP'] = '08'
-
-us3 = pandas.concat([us2[us2.STATEFP!='08'], merged])
-columns = us3.columns.values.tolist()
-us4 = us3.drop(columns=['Unnamed: 0', 'Unnamed_ 0', 'IndustryCl'])
-
-for year in years:
-    us4[year] = us4[year].astype('int')
-
-us4.to_file('usincome_final.shp')
-
-
-# ## Shrinking file size
-# We are duplicating the shapes three times (once for each attribute)
-# 
-# Split out the attributes from the geometries, two different dataframes
-
-gdf = gpd.read_file('usincome_final.shp')
-
-uscountyincome = pandas.DataFrame(gdf.drop(columns='geometry'))
-uscountyincome.to_csv('uscountyincome.csv')
-
-gdf = gdf[gdf.LineCode==3]
-
-gdf.to_file("uscountypcincome.gpkg", layer='pcincome', driver="GPKG")
-
-
+#
+# ## Rules
+#
+# Every rule gives the state, the GEOID of the combined area, its NAME and
+# NAMELSAD, the COUNTYFP of its members and the first and last year in
+# which BEA reports the members separately (None if it never does). The
+# first member is the one that includes the others outside those years.
+#
+# Where BEA reports the members, their personal income and population are
+# added up and per capita income is recomputed; otherwise the combined
+# area takes BEA's record for its GEOID. Missing values count as zero.
+
+combinations = [
+    ('51', '51901', 'Albemarle', 'Albemarle + Charlottesville, VA*', ['003', '540'], None),
+    ('51', '51903', 'Alleghany', 'Alleghany + Covington, VA*', ['005', '580'], None),
+    ('51', '51907', 'Augusta', 'Augusta, Staunton + Waynesboro, VA*', ['015', '790', '820'], None),
+    ('51', '51911', 'Campbell', 'Campbell + Lynchburg, VA*', ['031', '680'], None),
+    ('51', '51913', 'Carroll', 'Carroll + Galax, VA*', ['035', '640'], None),
+    ('51', '51918', 'Dinwiddie', 'Dinwiddie, Colonial Heights + Petersburg, VA*',
+     ['053', '570', '730'], None),
+    ('51', '51919', 'Fairfax', 'Fairfax, Fairfax City + Falls Church, VA*',
+     ['059', '600', '610'], None),
+    ('51', '51921', 'Frederick', 'Frederick + Winchester, VA*', ['069', '840'], None),
+    ('51', '51923', 'Greensville', 'Greensville + Emporia, VA*', ['081', '595'], None),
+    ('51', '51929', 'Henry', 'Henry + Martinsville, VA*', ['089', '690'], None),
+    ('51', '51931', 'James City', 'James City + Williamsburg, VA*', ['095', '830'], None),
+    ('51', '51933', 'Montgomery', 'Montgomery + Radford, VA*', ['121', '750'], None),
+    ('51', '51939', 'Pittsylvania', 'Pittsylvania + Danville, VA*', ['143', '590'], None),
+    ('51', '51941', 'Prince George', 'Prince George + Hopewell, VA*', ['149', '670'], None),
+    ('51', '51942', 'Prince William', 'Prince William, Manassas + Manassas Park, VA*',
+     ['153', '683', '685'], None),
+    ('51', '51944', 'Roanoke', 'Roanoke + Salem, VA*', ['161', '775'], None),
+    ('51', '51945', 'Rockbridge', 'Rockbridge, Buena Vista + Lexington, VA*',
+     ['163', '530', '678'], None),
+    ('51', '51947', 'Rockingham', 'Rockingham + Harrisonburg, VA*', ['165', '660'], None),
+    ('51', '51949', 'Southampton', 'Southampton + Franklin, VA*', ['175', '620'], None),
+    ('51', '51951', 'Spotsylvania', 'Spotsylvania + Fredericksburg, VA*', ['177', '630'], None),
+    ('51', '51953', 'Washington', 'Washington + Bristol, VA*', ['191', '520'], None),
+    ('51', '51955', 'Wise', 'Wise + Norton, VA*', ['195', '720'], None),
+    ('51', '51958', 'York', 'York + Poquoson, VA*', ['199', '735'], None),
+    ('55', '55901', 'Shawano+Menominee', 'Shawano+Menominee Counties', ['115', '078'], (1989, 2017)),
+    ('35', '35061', 'Cibola+Valencia', 'Cibola+Valencia Counties', ['061', '006'], (1982, 2017)),
+    ('04', '04027', 'Yuma+La Paz', 'Yuma+La Paz Counties', ['027', '012'], (1983, 2017)),
+    ('08', '08013', 'Boulder+Broomfield', 'Boulder+Broomfield Counties', ['013', '014'], (2002, 2017)),
+]
+
+
+def _rules(rules):
+    """
+    Rules as a table indexed by target GEOID and the table of their members.
+    """
+    table = pandas.DataFrame(rules, columns=['state', 'target', 'name', 'label',
+                                              'members', 'separate'])
+    members = table[['state', 'target', 'members', 'separate']].explode('members')
+    members['GEOID'] = members.state + members.members
+    members['primary'] = ~members.target.duplicated()
+    separate = members.separate.apply(lambda span: span or (numpy.nan, numpy.nan))
+    members['first'] = [first for first, last in separate]
+    members['last'] = [last for first, last in separate]
+    return table.set_index('target'), members.drop(columns=['members', 'separate'])
+
+
+def combine_counties(counties, rules=combinations):
+    """
+    Dissolve the members of every combination into a single county.
+    """
+    table, members = _rules(rules)
+    target = counties.GEOID.map(members.set_index('GEOID').target)
+    found = target.dropna().groupby(target).size()
+    expected = members.groupby('target').size()
+    for geoid in found.index[found != expected[found.index]]:
+        print('missed:', geoid, table.label[geoid])
+
+    combined = counties[target.notna()].assign(GEOID=target.dropna())
+    combined = combined.dissolve(by='GEOID', aggfunc='first', as_index=False)
+    info = table.loc[combined.GEOID]
+    combined['COUNTYFP'] = combined.GEOID.str[2:]
+    combined['NAME'] = info.name.values
+    combined['NAMELSAD'] = info.label.values
+    return pandas.concat([counties[target.isna()], combined], ignore_index=True)
+
+
+def combine_income(income, rules=combinations):
+    """
+    Replace the income records of the members of every combination by a
+    single set of records for the combined area.
+    """
+    table, members = _rules(rules)
+    parts = income.merge(members, on='GEOID')
+    year = numpy.array(years, dtype=float)
+    reported = (parts.primary.values[:, None]
+                | ((year >= parts['first'].values[:, None])
+                   & (year <= parts['last'].values[:, None])))
+    summed = parts[years].where(reported).groupby([parts.target, parts.LineCode]).sum(min_count=1)
+    summed.index.names = ['GEOID', 'LineCode']
+    if len(summed):
+        pcincome = numpy.trunc(summed.xs(1, level='LineCode') * 1000
+                               / summed.xs(2, level='LineCode'))
+        pcincome = pcincome.replace([numpy.inf, -numpy.inf], numpy.nan)
+        summed.loc[pcincome.index.map(lambda geoid: (geoid, 3))] = pcincome.values
+
+    # BEA's own record for the combined area, if it is not one of the members
+    own = income.GEOID.isin(table.index) & ~income.GEOID.isin(members.GEOID)
+    own = income[own].set_index(['GEOID', 'LineCode'])
+    primary = parts[parts.primary].drop(columns='GEOID').rename(columns={'target': 'GEOID'})
+    primary = primary[income.columns].set_index(['GEOID', 'LineCode'])
+    primary['GeoName'] = table.name[primary.index.get_level_values('GEOID')].values
+    combined = pandas.concat([own, primary[~primary.index.isin(own.index)]])
+    combined[years] = summed.reindex(combined.index).fillna(combined[years]).fillna(0)
+    combined = combined.reset_index()
+    combined['GeoFIPS'] = combined.GEOID
+
+    drop = income.GEOID.isin(members.GEOID) | income.GEOID.isin(table.index)
+    return pandas.concat([income[~drop], combined[income.columns]], ignore_index=True)
+
+
+# ## Build stages
+#
+# Each stage's result is stored under `.stages/`, keyed by a hash of what
+# went into it: the source files it reads, the keys of the stages it uses
+# and its code, including the functions, classes and constants of this
+# script that it refers to. The combination pass is cheap and reruns
+# whenever a rule changes, but states are only joined again when their own
+# rules change.
+#
+# Tables are stored as (Geo)Parquet, which keeps full column names and
+# float year columns, unlike the shapefiles this script used to pass
+# between steps. With `handoff='memory'` nothing is written and stages only
+# hand results over within the run.
+
+CACHE = '.stages'
+handoffs = ['parquet', 'memory']
+
+
+def _code(obj, seen=None):
+    """
+    Source of a function or class and of the module-level names it uses.
+    """
+    seen = set() if seen is None else seen
+    if id(obj) in seen:
+        return ''
+    seen.add(id(obj))
+    parts = [inspect.getsource(obj)]
+    codes = [obj.__code__] if inspect.isfunction(obj) else []
+    while codes:
+        code = codes.pop()
+        codes.extend(c for c in code.co_consts if inspect.iscode(c))
+        for name in code.co_names:
+            ref = globals().get(name)
+            if (inspect.isfunction(ref) or inspect.isclass(ref)) \
+                    and ref.__module__ == __name__:
+                parts.append(_code(ref, seen))
+            elif isinstance(ref, (str, int, float, list, tuple)) and name not in seen:
+                seen.add(name)
+                parts.append('%s = %r' % (name, ref))
+    return '\n'.join(parts)
+
+
+def _digest(path):
+    sha = hashlib.sha1()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 20), b''):
+            sha.update(block)
+    return sha.hexdigest()
+
+
+class StageCache:
+    """
+    Results of build stages, keyed by the hash of their inputs and code.
+
+    GeoDataFrames are stored as GeoParquet, DataFrames as Parquet and
+    anything else pickled; only the latest result of every stage is kept.
+    With `handoff='memory'` results are only held for the current run.
+    """
+    def __init__(self, path=CACHE, handoff='parquet'):
+        if handoff not in handoffs:
+            raise ValueError('handoff must be one of %s' % handoffs)
+        self.path = path
+        self.handoff = handoff
+        self.memory = {}
+        if handoff != 'memory':
+            os.makedirs(path, exist_ok=True)
+
+    def key(self, name, fn, inputs=(), files=()):
+        sha = hashlib.sha1(_code(fn).encode('utf-8'))
+        for item in inputs:
+            sha.update(repr(item).encode('utf-8'))
+        for path in files:
+            sha.update(_digest(path).encode('utf-8'))
+        return '%s-%s' % (name, sha.hexdigest()[:16])
+
+    def get(self, key):
+        if self.handoff == 'memory':
+            return self.memory[key]
+        base = os.path.join(self.path, key)
+        if os.path.exists(base + '.geo.parquet'):
+            return geopandas.read_parquet(base + '.geo.parquet')
+        if os.path.exists(base + '.parquet'):
+            return pandas.read_parquet(base + '.parquet')
+        if os.path.exists(base + '.pkl'):
+            with open(base + '.pkl', 'rb') as f:
+                return pickle.load(f)
+        raise KeyError(key)
+
+    def put(self, key, value):
+        if self.handoff == 'memory':
+            self.memory[key] = value
+            return
+        name = os.path.join(self.path, key.rsplit('-', 1)[0])
+        for stale in glob.glob(name + '-*'):
+            if stale.rsplit('-', 1)[0] == name:
+                os.remove(stale)
+        base = os.path.join(self.path, key)
+        if isinstance(value, geopandas.GeoDataFrame):
+            path = base + '.geo.parquet'
+            value.to_parquet(path + '.tmp')
+        elif isinstance(value, pandas.DataFrame):
+            path = base + '.parquet'
+            value.to_parquet(path + '.tmp')
+        else:
+            path = base + '.pkl'
+            with open(path + '.tmp', 'wb') as f:
+                pickle.dump(value, f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(path + '.tmp', path)
+
+    def run(self, name, fn, *args, inputs=(), files=()):
+        """
+        Result of `fn(*args)` and its key, computed only if not cached.
+        `args` are identified by `inputs`, such as the keys of the stages
+        that produced them.
+        """
+        key = self.key(name, fn, inputs=inputs, files=files)
+        try:
+            return self.get(key), key
+        except KeyError:
+            value = fn(*args)
+            self.put(key, value)
+            return value, key
+
+
+def write_outputs(states, crs):
+    """
+    Stack the joined states and write `uscountyincome.csv` and
+    `uscountypcincome.gpkg`.
+    """
+    mismatch = sorted(st for st, gdf in states.items() if gdf is None)
+    if mismatch:
+        print('Counties and income records do not match for:', mismatch)
+    us = pandas.concat([states[st] for st in sorted(states) if states[st] is not None],
+                       ignore_index=True)
+    us = geopandas.GeoDataFrame(us, geometry='geometry', crs=crs)
+
+    # ## Shrinking file size
+    # We are duplicating the shapes three times (once for each attribute)
+    #
+    # Split out the attributes from the geometries, two different dataframes
+
+    uscountyincome = pandas.DataFrame(us.drop(columns='geometry'))
+    uscountyincome.to_csv('uscountyincome.csv')
+
+    gdf = us[us.LineCode == 3]
+
+    gdf.to_file("uscountypcincome.gpkg", layer='pcincome', driver="GPKG")
+
+    # The same table with every county stored once and the incomes in a
+    # float32 county by year matrix that `bookdata.load_us_county_income`
+    # memory-maps and joins back on demand
+
+    gdf = gdf.reset_index(drop=True)
+    gdf.drop(columns=years).to_parquet('uscounties.parquet')
+    matrix = pyarrow.table({year: gdf[year].to_numpy(dtype='float32') for year in years})
+    feather.write_feather(matrix, 'uscountypcincome.arrow', compression='uncompressed')
+
+
+outputs = ['uscountyincome.csv', 'uscountypcincome.gpkg', 'uscounties.parquet',
+           'uscountypcincome.arrow']
+
+
+def build(cache=CACHE, handoff='parquet'):
+    """
+    Build `uscountyincome.csv` and `uscountypcincome.gpkg`, rerunning only
+    the stages whose inputs or code changed since the last build.
+    `handoff` is one of `handoffs`.
+    """
+    stages = StageCache(cache, handoff)
+    shapefile = [p for p in glob.glob(os.path.splitext(COUNTIES)[0] + '.*')
+                 if not p.endswith('.xml')]
+    counties, counties_key = stages.run('counties', load_counties, files=sorted(shapefile))
+    income, income_key = stages.run('income', load_income, files=[INCOME])
+    counties, _ = stages.run('counties_combined', combine_counties, counties,
+                             inputs=[counties_key, combinations])
+    income, _ = stages.run('income_combined', combine_income, income,
+                           inputs=[income_key, combinations])
+    income = dict(list(income.groupby(income.GEOID.str[:2])))
+
+    code = [_code(combine_counties), _code(combine_income)]
+    rules = {st: [rule for rule in combinations if rule[0] == st] for st in income}
+    keys = {st: stages.key('state' + st, merge_state,
+                           inputs=[counties_key, income_key, st, rules[st]] + code)
+            for st in income}
+    states = {}
+    for st, key in keys.items():
+        try:
+            states[st] = stages.get(key)
+        except KeyError:
+            pass
+    stale = sorted(set(keys) - set(states))
+    if stale:
+        # one attribute merge per state, cheaper than pickling it to a process
+        print('Joining states:', stale)
+        for st in stale:
+            states[st] = merge_state(income[st], counties[counties.STATEFP == st],
+                                     not rules[st])
+            stages.put(keys[st], states[st])
+
+    key = stages.key('outputs', write_outputs, inputs=sorted(keys.values()))
+    try:
+        stages.get(key)
+        if all(os.path.exists(path) for path in outputs):
+            return
+    except KeyError:
+        pass
+    write_outputs(states, counties.crs)
+    stages.put(key, outputs)
+
+
+def benchmark():
+    """
+    Time end-to-end builds for every hand-off, and one round trip of the
+    per capita income table through a shapefile, as the script used to do
+    four times, against one through GeoParquet.
+    """
+    import tempfile
+    import time
+
+    timings = {}
+    with tempfile.TemporaryDirectory() as tmp:
+        cache = os.path.join(tmp, 'stages')
+        runs = [('build, memory', dict(handoff='memory')),
+                ('build, parquet, cold', dict(cache=cache)),
+                ('build, parquet, warm', dict(cache=cache))]
+        for label, kwargs in runs:
+            start = time.perf_counter()
+            build(**kwargs)
+            timings[label] = time.perf_counter() - start
+
+        gdf = geopandas.read_file('uscountypcincome.gpkg')
+        shp = os.path.join(tmp, 'roundtrip.shp')
+        parquet = os.path.join(tmp, 'roundtrip.parquet')
+        start = time.perf_counter()
+        gdf.to_file(shp)
+        geopandas.read_file(shp)
+        timings['round trip, shapefile'] = time.perf_counter() - start
+        start = time.perf_counter()
+        gdf.to_parquet(parquet)
+        geopandas.read_parquet(parquet)
+        timings['round trip, geoparquet'] = time.perf_counter() - start
+
+    for label, seconds in timings.items():
+        print('%-24s %8.3f s' % (label, seconds))
+    return timings
+
+
+if __name__ == '__main__':
+    import argparse
+
+    parser = argparse.ArgumentParser(description='Build the US county income dataset.')
+    parser.add_argument('--handoff', choices=handoffs, default='parquet',
+                        help='how stages hand results to each other')
+    parser.add_argument('--benchmark', action='store_true',
+                        help='time the build and the hand-off formats')
+    args = parser.parse_args()
+    if args.benchmark:
+        benchmark()
+    else:
+        build(handoff=args.handoff)
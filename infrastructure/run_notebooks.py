@@ -0,0 +1,324 @@
+# # Executing the book notebooks
+#
+# Runs the chapters in a pool of worker processes, one kernel each, and
+# keeps every executed notebook in a cache keyed by what its results depend
+# on: the source of its cells, the data files it reads (`../data/...`
+# paths in the code), the `book*.py` helpers it imports, and the versions of
+# Python and the installed packages. A notebook whose key has not changed is
+# not run again, so editing one chapter only re-executes that chapter.
+#
+# Wall time and peak memory of the kernel are recorded for every code cell
+# into a CSV report. From the root of the repository:
+#
+#     python infrastructure/run_notebooks.py [--workers n] [notebooks ...]
+#
+# or `make execute`.
+
+import csv
+import glob
+import hashlib
+import json
+import os
+import re
+import shutil
+import sys
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+import nbformat
+from nbclient import NotebookClient
+from nbclient.exceptions import CellExecutionError, CellTimeoutError, DeadKernelError
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+NOTEBOOKS = os.path.join(ROOT, 'notebooks')
+CACHE = os.path.join(ROOT, '.notebook_cache')
+REPORT = 'build_report.csv'
+
+# paths to the data folder in the code, e.g. "../data/tokyo/tokyo_clean.csv"
+DATA_PATH = re.compile(r'''['"]((?:\.\./)+data/[^'"]+)['"]''')
+# helpers shipped next to the notebooks
+HELPER = re.compile(r'^\s*(?:from|import)\s+(book\w+)', re.M)
+
+# seconds between two measures of the memory of a kernel
+interval = 0.05
+
+columns = ['notebook', 'cell', 'seconds', 'peak_mb', 'cached']
+
+
+def _digest(path):
+    sha = hashlib.sha1()
+    paths = [path]
+    if os.path.isdir(path):
+        paths = sorted(os.path.join(d, f) for d, _, files in os.walk(path) for f in files)
+    for p in paths:
+        sha.update(os.path.relpath(p, ROOT).encode('utf-8'))
+        with open(p, 'rb') as f:
+            for block in iter(lambda: f.read(2 ** 20), b''):
+                sha.update(block)
+    return sha.hexdigest()
+
+
+def _helpers(source, seen=None):
+    """
+    `book*.py` modules imported by some code, and those they import
+    """
+    seen = set() if seen is None else seen
+    for name in HELPER.findall(source):
+        path = os.path.join(NOTEBOOKS, name + '.py')
+        if name not in seen and os.path.exists(path):
+            seen.add(name)
+            with open(path) as f:
+                _helpers(f.read(), seen)
+    return seen
+
+
+_environment = None
+
+
+def environment():
+    """
+    Python version and installed distributions, computed once per process
+    """
+    global _environment
+    if _environment is None:
+        from importlib import metadata
+
+        versions = sorted('%s==%s' % (d.metadata['Name'], d.version)
+                          for d in metadata.distributions())
+        _environment = hashlib.sha1(repr((sys.version, versions)).encode('utf-8')).hexdigest()
+    return _environment
+
+
+def notebook_key(path):
+    """
+    Hash of everything the outputs of a notebook depend on
+
+    Parameters
+    ----------
+
+    path: string
+          path to the notebook
+
+    Returns
+    -------
+
+    hex digest
+    """
+    nb = nbformat.read(path, as_version=4)
+    code = '\n'.join(cell.source for cell in nb.cells if cell.cell_type == 'code')
+    sha = hashlib.sha1()
+    sha.update(json.dumps([(cell.cell_type, cell.source) for cell in nb.cells]).encode('utf-8'))
+    sha.update(nb.metadata.get('kernelspec', {}).get('name', '').encode('utf-8'))
+    here = os.path.dirname(os.path.abspath(path))
+    for data in sorted(set(DATA_PATH.findall(code))):
+        # files fetched or written by the notebook itself are not there yet
+        full = os.path.normpath(os.path.join(here, data))
+        sha.update(data.encode('utf-8'))
+        sha.update((_digest(full) if os.path.exists(full) else 'missing').encode('utf-8'))
+    for name in sorted(_helpers(code)):
+        sha.update(_digest(os.path.join(NOTEBOOKS, name + '.py')).encode('utf-8'))
+    sha.update(environment().encode('utf-8'))
+    return sha.hexdigest()
+
+
+def _kernel_pid(client):
+    provisioner = getattr(client.km, 'provisioner', None)
+    if provisioner is not None:
+        return provisioner.process.pid
+    return client.km.kernel.pid
+
+
+class _Peak(threading.Thread):
+    """
+    Largest resident memory of a process since the last `reset`
+    """
+
+    def __init__(self, pid):
+        super().__init__(daemon=True)
+        import psutil
+
+        self.process = psutil.Process(pid)
+        self.peak = 0
+        self.stopped = threading.Event()
+
+    def run(self):
+        while not self.stopped.wait(interval):
+            try:
+                self.peak = max(self.peak, self.process.memory_info().rss)
+            except Exception:
+                return
+
+    def reset(self):
+        # cells shorter than `interval` are measured at least once
+        try:
+            self.peak = max(self.peak, self.process.memory_info().rss)
+        except Exception:
+            pass
+        peak, self.peak = self.peak, 0
+        return peak
+
+
+def execute(path, timeout=600):
+    """
+    Run a notebook in a fresh kernel from its own folder
+
+    Parameters
+    ----------
+
+    path: string
+          path to the notebook
+
+    timeout: int
+             seconds a cell may run for
+
+    Returns
+    -------
+
+    nb: executed notebook
+
+    rows: list of (cell, seconds, peak_mb) for the code cells; peak memory
+          is None without `psutil`
+    """
+    nb = nbformat.read(path, as_version=4)
+    rows = []
+    state = {}
+
+    def start(cell, cell_index, **kwds):
+        if 'peak' not in state:
+            try:
+                state['peak'] = _Peak(_kernel_pid(client))
+                state['peak'].start()
+            except ImportError:
+                state['peak'] = None
+        if state['peak'] is not None:
+            state['peak'].reset()
+        state['start'] = time.perf_counter()
+
+    def executed(cell, cell_index, **kwds):
+        seconds = time.perf_counter() - state['start']
+        peak = state['peak'].reset() if state['peak'] is not None else None
+        rows.append((cell_index, round(seconds, 3),
+                     None if peak is None else round(peak / 2 ** 20, 1)))
+
+    client = NotebookClient(nb, timeout=timeout,
+                            resources={'metadata': {'path': os.path.dirname(path)}},
+                            on_cell_execute=start, on_cell_executed=executed)
+    try:
+        client.execute()
+    finally:
+        if state.get('peak') is not None:
+            state['peak'].stopped.set()
+    return nb, rows
+
+
+def run(path, cache=CACHE, timeout=600, force=False):
+    """
+    Executed copy of a notebook, from the cache if its key has not changed
+
+    Returns
+    -------
+
+    name, path to the executed notebook in the cache (None if it failed),
+    report rows, whether it came from the cache and the error if any
+    """
+    name = os.path.splitext(os.path.basename(path))[0]
+    key = notebook_key(path)
+    stem = os.path.join(cache, '%s-%s' % (name, key[:16]))
+    if not force and os.path.exists(stem + '.ipynb') and os.path.exists(stem + '.json'):
+        with open(stem + '.json') as f:
+            return name, stem + '.ipynb', json.load(f), True, None
+    try:
+        nb, rows = execute(path, timeout)
+    # a failing, hung or dead kernel only fails its own notebook
+    except (CellExecutionError, CellTimeoutError, DeadKernelError) as error:
+        return name, None, [], False, str(error)
+    os.makedirs(cache, exist_ok=True)
+    for old in glob.glob(os.path.join(cache, name + '-*')):
+        os.remove(old)
+    nbformat.write(nb, stem + '.ipynb')
+    with open(stem + '.json', 'w') as f:
+        json.dump(rows, f)
+    return name, stem + '.ipynb', rows, False, None
+
+
+def build(paths=None, workers=None, cache=CACHE, timeout=600, output_dir=None,
+          report=REPORT, force=False):
+    """
+    Execute notebooks in parallel, reusing cached results
+
+    Parameters
+    ----------
+
+    paths: list
+           notebooks to run, all those in `notebooks/` if None
+
+    workers: int
+             processes (and kernels) running at once, all cores if None
+
+    cache: string
+           folder with the executed notebooks
+
+    timeout: int
+             seconds a cell may run for
+
+    output_dir: string
+                folder to copy the executed notebooks to, if any
+
+    report: string
+            CSV file with the wall time and peak memory of every code cell
+
+    force: Boolean
+           run every notebook, even if its results are cached (True)
+
+    Returns
+    -------
+
+    list of the notebooks that failed
+    """
+    paths = paths or sorted(glob.glob(os.path.join(NOTEBOOKS, '*.ipynb')))
+    with ProcessPoolExecutor(workers) as pool:
+        jobs = [pool.submit(run, os.path.abspath(path), cache, timeout, force) for path in paths]
+        results = [job.result() for job in jobs]
+
+    failed = []
+    if output_dir:
+        os.makedirs(output_dir, exist_ok=True)
+    with open(report, 'w', newline='') as f:
+        writer = csv.writer(f)
+        writer.writerow(columns)
+        for name, executed, rows, cached, error in results:
+            if error is not None:
+                failed.append(name)
+                print('%s: failed\n%s' % (name, error))
+                continue
+            seconds = sum(row[1] for row in rows)
+            print('%s: %.1fs%s' % (name, seconds, ' (cached)' if cached else ''))
+            writer.writerows([name, *row, cached] for row in rows)
+            if output_dir:
+                shutil.copy(executed, os.path.join(output_dir, name + '.ipynb'))
+    return failed
+
+
+if __name__ == '__main__':
+    import argparse
+
+    parser = argparse.ArgumentParser(description='Execute the book notebooks.')
+    parser.add_argument('--workers', type=int,
+                        help='number of notebooks run at once (default: all cores)')
+    parser.add_argument('notebooks', nargs='*',
+                        help='notebooks to run (default: notebooks/*.ipynb)')
+    parser.add_argument('--timeout', type=int, default=600,
+                        help='seconds a cell may run for')
+    parser.add_argument('--cache', default=CACHE,
+                        help='folder with the executed notebooks')
+    parser.add_argument('--output-dir',
+                        help='folder to copy the executed notebooks to')
+    parser.add_argument('--report', default=REPORT,
+                        help='CSV report of wall time and peak memory per cell')
+    parser.add_argument('--force', action='store_true',
+                        help='run notebooks even if their results are cached')
+    args = parser.parse_args()
+    failed = build(args.notebooks, args.workers, args.cache, args.timeout,
+                   args.output_dir, args.report, args.force)
+    sys.exit(1 if failed else 0)
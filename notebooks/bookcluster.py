@@ -0,0 +1,265 @@
+import numpy
+
+
+# clustering and regionalization for many numbers of clusters at once
+#
+# A hierarchical clustering is one tree of merges, whatever the number of
+# clusters: each linkage is fit once, with the connectivity matrix built
+# once for all of them, and every k is read off the tree by undoing its last
+# k - 1 merges. K-means is fit per k, in mini batches on large tables. Fits
+# are spread over processes, and the solutions are compared in one table of
+# fit and compactness measures.
+
+linkages = ['ward', 'average', 'complete', 'single']
+
+# tables larger than this are clustered with MiniBatchKMeans by default
+mini_batch_size = 50000
+
+
+def _connectivity(w, n):
+    import scipy.sparse
+
+    if w is None:
+        return None
+    matrix = w.sparse if hasattr(w, 'sparse') else w
+    matrix = scipy.sparse.csr_matrix(matrix, dtype=float)
+    if matrix.shape != (n, n):
+        raise ValueError('the connectivity matrix must be (n, n)')
+    # clustering needs symmetric links
+    return ((matrix + matrix.T) > 0).astype(float).tocsr()
+
+
+def _tree(x, connectivity, linkage):
+    """
+    (n - 1, 2) merges of a hierarchical clustering, in order
+    """
+    import warnings
+
+    from sklearn.cluster import linkage_tree, ward_tree
+
+    with warnings.catch_warnings():
+        # disconnected graphs are completed by scikit-learn, with a warning
+        warnings.simplefilter('ignore', UserWarning)
+        if linkage == 'ward':
+            return ward_tree(x, connectivity=connectivity)[0]
+        return linkage_tree(x, connectivity=connectivity, linkage=linkage)[0]
+
+
+def cut(children, k):
+    """
+    Labels of the k clusters left before the last k - 1 merges of a tree
+
+    Parameters
+    ----------
+
+    children: array
+              (n - 1, 2) merges, as `children_` of `AgglomerativeClustering`
+
+    k: int
+       number of clusters
+
+    Returns
+    -------
+
+    (n,) array of labels from 0 to k - 1, in order of first appearance
+    """
+    n = len(children) + 1
+    merges = n - k
+    parent = numpy.arange(2 * n - 1)
+    parent[children[:merges].ravel()] = numpy.repeat(n + numpy.arange(merges), 2)
+    # jump to the root of every node, doubling the distance each time
+    while True:
+        jumped = parent[parent]
+        if (jumped == parent).all():
+            break
+        parent = jumped
+    _, first, labels = numpy.unique(parent[:n], return_index=True, return_inverse=True)
+    # renumber by first appearance, so labels do not depend on node ids
+    order = numpy.argsort(numpy.argsort(first))
+    return order[labels]
+
+
+def _kmeans(x, k, seed, mini_batch):
+    from sklearn.cluster import KMeans, MiniBatchKMeans
+
+    cls = MiniBatchKMeans if mini_batch else KMeans
+    return cls(n_clusters=k, random_state=seed).fit(x).labels_
+
+
+def _fit(method, x, ks, connectivity, seed, mini_batch):
+    """
+    Labels of a method for every k, as a (len(ks), n) array
+    """
+    if method == 'kmeans':
+        return numpy.stack([_kmeans(x, k, seed, mini_batch) for k in ks])
+    children = _tree(x, connectivity, method)
+    return numpy.stack([cut(children, k) for k in ks])
+
+
+def _fragments(labels, connectivity):
+    # contiguous pieces: connected components of the links within clusters
+    import scipy.sparse
+    from scipy.sparse.csgraph import connected_components
+
+    links = connectivity.tocoo()
+    inside = labels[links.row] == labels[links.col]
+    graph = scipy.sparse.csr_matrix((links.data[inside], (links.row[inside], links.col[inside])),
+                                    shape=connectivity.shape)
+    return connected_components(graph, directed=False)[0]
+
+
+def _compactness(geometry, labels):
+    # mean isoperimetric quotient of the dissolved clusters
+    import shapely
+
+    geometry = numpy.asarray(geometry)
+    shapes = [shapely.union_all(geometry[labels == c]) for c in numpy.unique(labels)]
+    areas, perimeters = shapely.area(shapes), shapely.length(shapes)
+    return numpy.mean(4 * numpy.pi * areas / perimeters ** 2)
+
+
+def metrics(x, labels, connectivity=None, geometry=None, silhouette_sample=10000, seed=12345):
+    """
+    Fit and compactness measures of a clustering
+
+    Parameters
+    ----------
+
+    x: array
+       (n, p) values clustered
+
+    labels: array
+            (n,) cluster of every observation
+
+    connectivity: scipy.sparse matrix
+                  (n, n) links between observations, to count contiguous
+                  pieces
+
+    geometry: array, GeoSeries
+              (n,) shapes of the observations, to measure compactness
+
+    silhouette_sample: int
+                       observations the silhouette score is estimated on,
+                       all of them if None
+
+    seed: int
+          seed of the silhouette sample
+
+    Returns
+    -------
+
+    dict with the within-cluster sum of squares (`inertia`), the
+    `calinski_harabasz`, `davies_bouldin` and `silhouette` scores, the number
+    of contiguous `fragments` (equal to k for a regionalization) and the mean
+    isoperimetric quotient (`ipq`, 1 for circles) of the clusters
+    """
+    from sklearn import metrics as skmetrics
+
+    x = numpy.asarray(x, dtype=float)
+    means = numpy.stack([numpy.bincount(labels, x[:, j]) for j in range(x.shape[1])], axis=1)
+    means /= numpy.bincount(labels)[:, None]
+    sample = silhouette_sample if silhouette_sample and silhouette_sample < len(x) else None
+    return {'inertia': ((x - means[labels]) ** 2).sum(),
+            'calinski_harabasz': skmetrics.calinski_harabasz_score(x, labels),
+            'davies_bouldin': skmetrics.davies_bouldin_score(x, labels),
+            'silhouette': skmetrics.silhouette_score(x, labels, sample_size=sample,
+                                                     random_state=seed),
+            'fragments': numpy.nan if connectivity is None else _fragments(labels, connectivity),
+            'ipq': numpy.nan if geometry is None else _compactness(geometry, labels)}
+
+
+def sweep(db, columns, ks, methods=('kmeans', 'ward'), w=None, workers=1, seed=12345,
+          mini_batch=None, compactness=True, silhouette_sample=10000):
+    """
+    Clusterings of a table for many numbers of clusters and methods
+
+    Parameters
+    ----------
+
+    db: DataFrame, GeoDataFrame
+        table with the clustering variables, already scaled
+
+    columns: list
+             names of the clustering variables
+
+    ks: list
+        numbers of clusters, at least 2
+
+    methods: list
+             'kmeans' and hierarchical linkages out of `linkages`
+
+    w: libpysal W, scipy.sparse matrix
+       spatial links; hierarchical methods only merge linked clusters
+       (regionalization), and fragments are counted along them
+
+    workers: int
+             processes fitting methods (and k-means for every k) at once,
+             all cores if None, in this process if 1
+
+    seed: int
+          seed of k-means and of the silhouette sample
+
+    mini_batch: Boolean
+                use `MiniBatchKMeans`; by default, for tables larger than
+                `mini_batch_size`
+
+    compactness: Boolean
+                 measure the compactness of the clusters of a GeoDataFrame
+                 (True)
+
+    silhouette_sample: int
+                       observations the silhouette score is estimated on,
+                       all of them if None
+
+    Returns
+    -------
+
+    table: pandas DataFrame indexed by method and k with the measures of
+           `metrics`
+
+    labels: pandas DataFrame indexed as `db` with a `<method><k>` column of
+            labels per solution
+
+    Examples
+    --------
+
+    >>> table, labels = sweep(db, cluster_variables, range(2, 11),
+    ...                       methods=['kmeans', 'ward'], w=w)
+    >>> table['silhouette'].unstack('method').plot()
+    >>> db['ward5'] = labels['ward5']
+    """
+    import pandas
+
+    unknown = set(methods) - set(['kmeans'] + linkages)
+    if unknown:
+        raise ValueError('unknown methods: %s' % sorted(unknown))
+    ks = sorted(ks)
+    if ks[0] < 2:
+        raise ValueError('clusterings need at least 2 clusters')
+    x = db[list(columns)].to_numpy(dtype=float)
+    connectivity = _connectivity(w, len(x))
+    if mini_batch is None:
+        mini_batch = len(x) > mini_batch_size
+
+    # one job per hierarchical method, and per k for k-means
+    jobs = [(method, [k] if method == 'kmeans' else ks)
+            for method in methods for k in (ks if method == 'kmeans' else [None])]
+    if workers == 1 or len(jobs) == 1:
+        fits = [_fit(method, x, group, connectivity, seed, mini_batch) for method, group in jobs]
+    else:
+        from concurrent.futures import ProcessPoolExecutor
+
+        with ProcessPoolExecutor(workers) as pool:
+            futures = [pool.submit(_fit, method, x, group, connectivity, seed, mini_batch)
+                       for method, group in jobs]
+            fits = [future.result() for future in futures]
+
+    geometry = getattr(db, 'geometry', None) if compactness else None
+    rows, solutions = {}, {}
+    for (method, group), fit in zip(jobs, fits):
+        for k, labels in zip(group, fit):
+            rows[method, k] = metrics(x, labels, connectivity, geometry, silhouette_sample, seed)
+            solutions['%s%d' % (method, k)] = labels
+    table = pandas.DataFrame.from_dict(rows, orient='index')
+    table.index.names = ['method', 'k']
+    return table, pandas.DataFrame(solutions, index=db.index)
@@ -1,38 +1,572 @@
+import hashlib
 import os
+import threading
+from collections import OrderedDict, namedtuple
 
 ourpath = os.path.abspath(os.path.dirname(__file__))
 datapath = os.path.join(ourpath, '../data')
 
+# GeoParquet copies of the vector sources live here, keyed by content hash
+cachepath = os.environ.get('BOOKDATA_CACHE', os.path.join(datapath, '.cache'))
+
+# files that make up a dataset together with the one we are pointed at
+_sidecars = {'.shp': ('.shx', '.dbf', '.prj', '.cpg')}
+
+# (path, (mtime, size) of every member) -> content digest
+_digests = {}
+
+# process-wide LRU of loaded GeoDataFrames, bounded by `memory_budget` bytes
+memory_budget = int(os.environ.get('BOOKDATA_MEMORY_BUDGET', 2**30))
+_memory = OrderedDict()
+_memory_lock = threading.Lock()
+_stats = {'hits': 0, 'misses': 0, 'evictions': 0, 'bytes': 0}
+
+CacheInfo = namedtuple('CacheInfo', 'hits misses evictions entries nbytes budget')
+
 
 def san_diego_tracts():
-    return os.path.join(datapath, 'sandiego/sd_tracts_acs_clean.shp') 
+    return os.path.join(datapath, 'sandiego/sandiego_tracts.gpkg')
 
 def san_diego_airbnbs():
     raise NotImplementedError
     return os.path.join(datapath, '...')
 
 def texas():
-    return os.path.join(datapath, 'texas.shp')
+    return os.path.join(datapath, 'texas/texas.shp')
 
 def mexico():
-    return os.path.join(datapath, 'mexicojoin.shp')
+    return os.path.join(datapath, 'mexico/mexicojoin.shp')
 
 def brexit():
-    return os.path.join(datapath, 'brexit_vote.csv')
+    return os.path.join(datapath, 'brexit/brexit_vote.csv')
 
 def lads():
-    f = ('Local_Authority_Districts_December_2016_Generalised_Clipped_Boundaries_in_the_UK_WGS84/'\
-         'Local_Authority_Districts_December_2016_Generalised_Clipped_Boundaries_in_the_UK_WGS84.shp')
-    return os.path.join(datapath, f)
+    return os.path.join(datapath, 'brexit/local_authority_districts.geojson')
 
 def san_diego_neighborhoods():
     return os.path.join(datapath, 'airbnb/neighbourhoods.geojson')
 
 def regression_airbnbs():
-    return os.path.join(datapath, 'airbnb/regression_db.geojson') 
+    return os.path.join(datapath, 'airbnb/regression_db.geojson')
 
-def texas():
-    return os.path.join(datapath, 'texas.shp')
+def us_county_income():
+    return os.path.join(datapath, 'us_county_income/uscountypcincome.gpkg')
 
-def mexico():
-    return os.path.join(datapath, 'mexicojoin.shp')
\ No newline at end of file
+def us_county_geometries():
+    return os.path.join(datapath, 'us_county_income/uscounties.parquet')
+
+def us_county_pcincome():
+    return os.path.join(datapath, 'us_county_income/uscountypcincome.arrow')
+
+
+def _members(path):
+    root, ext = os.path.splitext(path)
+    extra = [root + s for s in _sidecars.get(ext.lower(), ())]
+    return [path] + [p for p in extra if os.path.exists(p)]
+
+
+def _digest(path):
+    """
+    Content hash of a data source.
+
+    The hash is only recomputed when the modification time or size of one
+    of the files making up the source changes.
+    """
+    members = _members(path)
+    stamp = tuple((st.st_mtime_ns, st.st_size) for st in map(os.stat, members))
+    key = (path, stamp)
+    if key not in _digests:
+        sha = hashlib.sha1()
+        for member in members:
+            with open(member, 'rb') as f:
+                for block in iter(lambda: f.read(1 << 20), b''):
+                    sha.update(block)
+        _digests[key] = sha.hexdigest()
+    return _digests[key]
+
+
+def _cached(path, layer=None):
+    """
+    Location of the GeoParquet copy for `path` and the glob of older copies.
+    """
+    stem = os.path.splitext(os.path.basename(path))[0]
+    if layer is not None:
+        stem = '%s-%s' % (stem, layer)
+    stem = '%s-%s' % (stem, hashlib.sha1(path.encode('utf-8')).hexdigest()[:8])
+    name = '%s-%s.parquet' % (stem, _digest(path)[:16])
+    return os.path.join(cachepath, name), stem + '-*.parquet'
+
+
+def _nbytes(gdf):
+    """
+    Approximate in-memory size of a GeoDataFrame, coordinates included.
+    """
+    import shapely
+
+    nbytes = int(gdf.memory_usage(deep=True).sum())
+    for column in gdf.columns[gdf.dtypes == 'geometry']:
+        n = shapely.get_num_coordinates(gdf[column].values).sum()
+        nbytes += int(n) * 16
+    return nbytes
+
+
+def _copy_on_write():
+    import pandas
+
+    if int(pandas.__version__.split('.')[0]) >= 3:
+        return True
+    try:
+        return pandas.get_option('mode.copy_on_write') is True
+    except KeyError:
+        return False
+
+
+def _hand_out(gdf):
+    """
+    Copy of a cached frame that cannot modify the cached one.
+
+    Under pandas copy-on-write a shallow copy is enough and costs no data;
+    without it we fall back to a deep copy.
+    """
+    return gdf.copy(deep=not _copy_on_write())
+
+
+def _evict():
+    # callers hold _memory_lock
+    while _memory and _stats['bytes'] > memory_budget:
+        _, (_, nbytes) = _memory.popitem(last=False)
+        _stats['bytes'] -= nbytes
+        _stats['evictions'] += 1
+
+
+def _remember(key, value, nbytes=None):
+    # `nbytes` of values other than GeoDataFrames are given by the caller
+    nbytes = _nbytes(value) if nbytes is None else nbytes
+    if nbytes > memory_budget:
+        return
+    with _memory_lock:
+        if key in _memory:
+            _stats['bytes'] -= _memory.pop(key)[1]
+        _memory[key] = (value, nbytes)
+        _stats['bytes'] += nbytes
+        _evict()
+
+
+def _recall(key):
+    # the cached value, or None, counted as a hit or a miss
+    with _memory_lock:
+        if key in _memory:
+            _memory.move_to_end(key)
+            _stats['hits'] += 1
+            return _memory[key][0]
+        _stats['misses'] += 1
+    return None
+
+
+def cache_info():
+    """
+    Hit/miss counters and size of the in-memory cache of datasets, levels
+    of detail and matrices
+
+    Returns
+    -------
+
+    CacheInfo namedtuple with hits, misses, evictions, entries, nbytes and
+    budget (both in bytes)
+    """
+    with _memory_lock:
+        return CacheInfo(_stats['hits'], _stats['misses'], _stats['evictions'],
+                         len(_memory), _stats['bytes'], memory_budget)
+
+
+def cache_clear():
+    """
+    Drop every dataset held in memory and reset the counters.
+    """
+    with _memory_lock:
+        _memory.clear()
+        _stats.update(hits=0, misses=0, evictions=0, bytes=0)
+
+
+def set_memory_budget(nbytes):
+    """
+    Change the byte budget of the in-memory cache, evicting as needed.
+    """
+    global memory_budget
+    with _memory_lock:
+        memory_budget = int(nbytes)
+        _evict()
+
+
+def read_file(path, layer=None, refresh=False):
+    """
+    Read a vector dataset into a GeoDataFrame through the dataset caches
+
+    Parameters
+    ----------
+
+    path: string
+          path to a file readable by geopandas.read_file
+
+    layer: string
+           layer to read from multi-layer sources (e.g. GeoPackage)
+
+    refresh: Boolean
+             ignore an existing cached copy and rebuild it (True)
+
+    Returns
+    -------
+
+    geopandas GeoDataFrame
+
+    Notes
+    -----
+    Datasets already loaded in this process are served from an LRU cache
+    bounded by `memory_budget` bytes (see `cache_info`). Every caller gets
+    its own copy-on-write frame, so edits never leak into the cache.
+
+    Otherwise, the first read parses the source with geopandas.read_file and
+    writes a GeoParquet copy to `cachepath`; later reads of the unchanged
+    source are memory-mapped Parquet reads. Editing the source changes its
+    hash and invalidates both caches. Without pyarrow the on-disk cache is
+    bypassed. GeoParquet sources are read directly.
+    """
+    path = os.path.abspath(path)
+    key = (path, layer, _digest(path))
+    if not refresh:
+        with _memory_lock:
+            if key in _memory:
+                _memory.move_to_end(key)
+                _stats['hits'] += 1
+                return _hand_out(_memory[key][0])
+    with _memory_lock:
+        _stats['misses'] += 1
+    gdf = _read_file(path, layer, refresh)
+    _remember(key, gdf)
+    return _hand_out(gdf)
+
+
+def _read_file(path, layer=None, refresh=False):
+    import geopandas
+
+    if path.endswith('.parquet'):
+        return geopandas.read_parquet(path, memory_map=True)
+
+    cached, pattern = _cached(path, layer)
+    if os.path.exists(cached) and not refresh:
+        return geopandas.read_parquet(cached, memory_map=True)
+
+    gdf = geopandas.read_file(path, layer=layer)
+    try:
+        import pyarrow  # noqa: F401
+    except ImportError:
+        return gdf
+
+    import glob
+    os.makedirs(cachepath, exist_ok=True)
+    for stale in glob.glob(os.path.join(cachepath, pattern)):
+        os.remove(stale)
+    tmp = '%s.%d.tmp' % (cached, os.getpid())
+    gdf.to_parquet(tmp)
+    os.replace(tmp, cached)
+    return gdf
+
+
+def load_san_diego_tracts():
+    return read_file(san_diego_tracts())
+
+def load_texas():
+    return read_file(texas())
+
+def load_mexico():
+    return read_file(mexico())
+
+def load_lads():
+    return read_file(lads())
+
+def load_san_diego_neighborhoods():
+    return read_file(san_diego_neighborhoods())
+
+def load_regression_airbnbs():
+    return read_file(regression_airbnbs())
+
+def write_panel(gdf, columns, geometries, matrix):
+    """
+    Store a wide GeoDataFrame as a table of its rows and a matrix of columns
+
+    Parameters
+    ----------
+
+    gdf: geopandas GeoDataFrame
+         one row per unit, with `columns` holding repeated measurements
+
+    columns: list
+             columns of `gdf` that go into the matrix, such as years
+
+    geometries: string
+                path of the GeoParquet file for the other columns
+
+    matrix: string
+            path of the uncompressed Arrow (Feather) file for `columns`,
+            stored as float32 in the row order of `geometries`
+    """
+    import numpy
+    import pyarrow
+    from pyarrow import feather
+
+    gdf = gdf.reset_index(drop=True)
+    gdf.drop(columns=columns).to_parquet(geometries + '.tmp')
+    table = pyarrow.table({c: numpy.asarray(gdf[c], dtype='float32') for c in columns})
+    feather.write_feather(table, matrix + '.tmp', compression='uncompressed')
+    os.replace(geometries + '.tmp', geometries)
+    os.replace(matrix + '.tmp', matrix)
+
+
+def _us_county_panel():
+    """
+    Paths of the county table and income matrix, derived from the
+    GeoPackage into `cachepath` if the build has not written them.
+    """
+    geometries, matrix = us_county_geometries(), us_county_pcincome()
+    if os.path.exists(geometries) and os.path.exists(matrix):
+        return geometries, matrix
+
+    import glob
+    source = us_county_income()
+    stem = os.path.join(cachepath, 'uscountypanel-%s' % _digest(source)[:16])
+    geometries, matrix = stem + '.parquet', stem + '.arrow'
+    if not (os.path.exists(geometries) and os.path.exists(matrix)):
+        gdf = read_file(source)
+        os.makedirs(cachepath, exist_ok=True)
+        for stale in glob.glob(os.path.join(cachepath, 'uscountypanel-*')):
+            os.remove(stale)
+        write_panel(gdf, [c for c in gdf.columns if c.isdigit()], geometries, matrix)
+    return geometries, matrix
+
+
+def load_us_county_income(years=None):
+    """
+    US county per capita incomes, 1969-2017
+
+    Parameters
+    ----------
+
+    years: list
+           year columns (strings) to include, all of them by default (None)
+
+    Returns
+    -------
+
+    geopandas GeoDataFrame with one row per county and float32 year columns
+
+    Notes
+    -----
+    Geometries and attributes are stored once per county and the incomes in
+    a memory-mapped Arrow matrix, from which only `years` are read.
+    """
+    from pyarrow import feather
+
+    geometries, matrix = _us_county_panel()
+    incomes = feather.read_table(matrix, columns=years, memory_map=True)
+    gdf = read_file(geometries)
+    geometry = gdf.geometry.name
+    gdf = gdf.join(incomes.to_pandas())
+    return gdf[[c for c in gdf.columns if c != geometry] + [geometry]]
+
+
+def load_us_county_pcincome(years=None):
+    """
+    US county per capita incomes as a year by county matrix
+
+    Parameters
+    ----------
+
+    years: list
+           year columns (strings) to include, all of them by default (None)
+
+    Returns
+    -------
+
+    years: list of the years included
+
+    matrix: float32 array of shape (len(years), n_counties), with counties in
+            the row order of `load_us_county_income`
+    """
+    import numpy
+    from pyarrow import feather
+
+    _, matrix = _us_county_panel()
+    incomes = feather.read_table(matrix, columns=years, memory_map=True)
+    return incomes.column_names, numpy.stack([c.to_numpy() for c in incomes.columns])
+
+
+# # Derived data
+#
+# Weights, overlaps and simplified geometries are derived from tables that
+# are often not files (subsets, joins, reprojections). They are cached under
+# `cachepath` by a fingerprint of the geometries instead of a file hash, and
+# kept in the same in-memory LRU as the datasets.
+
+
+def fingerprint(gdf, *extra):
+    """
+    Hash identifying the geometries of a table and whatever they are used for
+
+    Parameters
+    ----------
+
+    gdf: geopandas GeoDataFrame or GeoSeries
+
+    *extra: values with a stable `repr` (parameters, versions, other
+            fingerprints) that also go into the hash
+
+    Returns
+    -------
+
+    hex digest of the geometries (WKB, missing ones as empty), their CRS,
+    the number of rows and `extra`
+    """
+    import shapely
+
+    sha = hashlib.sha1()
+    for wkb in shapely.to_wkb(gdf.geometry.values, hex=False):
+        sha.update(wkb if wkb is not None else b'')
+    crs = gdf.crs.to_wkt() if gdf.crs is not None else ''
+    sha.update(repr((crs, len(gdf)) + extra).encode('utf-8'))
+    return sha.hexdigest()
+
+
+def cached_matrix(path, build, refresh=False):
+    """
+    Sparse matrix stored in an `.npz` file, built the first time
+
+    Parameters
+    ----------
+
+    path: string
+          `.npz` file, named after a `fingerprint` of what the matrix is
+          built from
+
+    build: callable
+           returns the matrix when it is not cached
+
+    refresh: Boolean
+             build the matrix again even if it is cached (True)
+
+    Returns
+    -------
+
+    scipy.sparse CSR matrix, shared with the in-memory cache
+    """
+    import scipy.sparse
+
+    key = ('npz', path)
+    matrix = None if refresh else _recall(key)
+    if matrix is not None:
+        return matrix
+    if not refresh and os.path.exists(path):
+        matrix = scipy.sparse.load_npz(path).tocsr()
+    else:
+        matrix = scipy.sparse.csr_matrix(build())
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp = '%s.%d.tmp.npz' % (path[:-len('.npz')], os.getpid())
+        scipy.sparse.save_npz(tmp, matrix)
+        os.replace(tmp, path)
+    _remember(key, matrix, matrix.data.nbytes + matrix.indices.nbytes + matrix.indptr.nbytes)
+    return matrix
+
+
+# # Levels of detail
+#
+# Maps of whole countries are drawn with far more vertices than a figure can
+# show. Every table mapped with levels of detail is simplified once on a
+# shared topology (as the county build does with `topojson`), so neighbours
+# still meet, at the tolerances in `lod_levels`, given as fractions of the
+# larger side of its bounds. All levels are stored in one GeoParquet file
+# under `cachepath`, with a geometry column per tolerance, named by a hash of
+# the geometries (WKB) and their CRS; only the level asked for is read.
+
+# tolerances, as fractions of the larger side of the bounds, finest first
+lod_levels = [2 ** -13, 2 ** -12, 2 ** -11, 2 ** -10, 2 ** -9, 2 ** -8]
+
+
+def _simplify(geometry, tolerances):
+    """
+    Topology preserving simplifications of a GeoSeries, one per tolerance,
+    with missing and empty geometries left as they are.
+    """
+    import geopandas
+    import numpy
+    import topojson
+
+    present = numpy.flatnonzero(~(geometry.isna() | geometry.is_empty).to_numpy())
+    shapes = geopandas.GeoDataFrame(geometry=geometry.values[present], crs=geometry.crs)
+    topology = topojson.Topology(shapes, prequantize=False)
+    levels = {}
+    for tolerance in tolerances:
+        simplified = topology.toposimplify(tolerance).to_gdf().geometry
+        level = geometry.values.copy()
+        level[present[simplified.index.to_numpy()]] = simplified.values
+        levels['%.17g' % tolerance] = level
+    return levels
+
+
+def level_of_detail(gdf, tolerance=0, refresh=False):
+    """
+    Geometries of a table at the coarsest level of detail within a tolerance
+
+    Parameters
+    ----------
+
+    gdf: geopandas GeoDataFrame or GeoSeries
+
+    tolerance: float
+               largest simplification tolerance acceptable, in the units of
+               the CRS (e.g. half the size of a pixel on a map)
+
+    refresh: Boolean
+             simplify the geometries again even if the levels are cached
+             (True)
+
+    Returns
+    -------
+
+    geopandas GeoSeries indexed as `gdf`, its own geometries if no level is
+    within `tolerance`
+
+    Notes
+    -----
+    The first call for a table simplifies it at every one of `lod_levels`
+    and stores the levels in `cachepath`; later calls read a single level,
+    which stays in the in-memory cache (see `cache_info`).
+    """
+    import geopandas
+    import pyarrow.parquet
+
+    geometry = gdf.geometry
+    minx, miny, maxx, maxy = geometry.total_bounds
+    span = max(maxx - minx, maxy - miny)
+    within = [fraction * span for fraction in lod_levels if 0 < fraction * span <= tolerance]
+    if not within or (geometry.geom_type.isin(['Point', 'MultiPoint'])).all():
+        return geometry
+
+    key = fingerprint(gdf)
+    path = os.path.join(cachepath, 'lod-%s.parquet' % key[:16])
+    column = '%.17g' % max(within)
+    memory = ('lod', key, column)
+    level = None if refresh else _recall(memory)
+    if level is None:
+        # levels stored with other `lod_levels` are built again
+        if (refresh or not os.path.exists(path)
+                or column not in pyarrow.parquet.read_schema(path).names):
+            levels = _simplify(geometry, [fraction * span for fraction in lod_levels])
+            levels = geopandas.GeoDataFrame(levels, geometry=next(iter(levels)),
+                                            crs=geometry.crs)
+            os.makedirs(cachepath, exist_ok=True)
+            tmp = '%s.%d.tmp' % (path, os.getpid())
+            levels.to_parquet(tmp)
+            os.replace(tmp, path)
+        level = geopandas.read_parquet(path, columns=[column])
+        _remember(memory, level)
+    return geopandas.GeoSeries(level[column].values, index=gdf.index, crs=geometry.crs,
+                               name=geometry.name)
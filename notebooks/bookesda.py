@@ -0,0 +1,573 @@
+import numpy
+
+
+# permutation inference for many columns at once
+#
+# Every column of a table (e.g. one per year) is tested against the same
+# permutations of the observations. Permutation `i` is drawn from its own
+# generator seeded with `(seed, i)`, so results only depend on the seed and
+# not on how the permutations are batched or spread over processes.
+
+# permutations evaluated together in one sparse product
+batch_size = 32
+
+# largest number of simulated neighbor values drawn at once in local statistics
+chunk_size = 2**22
+
+
+def _matrix(y):
+    y = numpy.asarray(y, dtype=float)
+    if y.ndim == 1:
+        y = y[:, None]
+    return y
+
+
+def sparse_weights(w, transformation=None, star=False):
+    """
+    CSR matrix of a libpysal W, without changing the transformation of `w`
+
+    Parameters
+    ----------
+
+    w: libpysal W
+
+    transformation: string
+                    'b' (binary), 'r' (row standardized) or None for the
+                    current transformation of `w`
+
+    star: Boolean
+          make observations their own neighbor, as in esda (True): with
+          weight 1 if the weights are or become binary, as their closest
+          neighbor otherwise
+
+    Returns
+    -------
+
+    (n, n) scipy.sparse CSR matrix
+    """
+    import scipy.sparse
+
+    a = scipy.sparse.csr_matrix(w.sparse, dtype=float)
+    if star and not a.diagonal().any():
+        if 'b' in (w.transform.lower(), (transformation or '').lower()):
+            closest = numpy.ones(a.shape[0])
+        else:
+            closest = a.max(axis=1).toarray().ravel()
+        a = a.tolil()
+        a.setdiag(closest)
+        a = a.tocsr()
+    a.eliminate_zeros()
+    if transformation is None:
+        return a
+    if transformation.lower() == 'b':
+        a.data[:] = 1
+    elif transformation.lower() == 'r':
+        rows = numpy.asarray(a.sum(axis=1)).ravel()
+        rows[rows == 0] = 1
+        a = scipy.sparse.diags(1 / rows) @ a
+    else:
+        raise ValueError("transformation must be 'b', 'r' or None")
+    return a.tocsr()
+
+
+def permutations(n, start, stop, seed=12345):
+    """
+    Permutations `start` to `stop` of `range(n)` for a seed
+
+    Returns
+    -------
+
+    (stop - start, n) array, one permutation per row
+    """
+    return numpy.stack([numpy.random.default_rng((seed, i)).permutation(n)
+                        for i in range(start, stop)])
+
+
+def _shard(statistic, args, n, start, stop, seed):
+    sims = []
+    for first in range(start, stop, batch_size):
+        perms = permutations(n, first, min(first + batch_size, stop), seed)
+        sims.append(statistic(perms, *args))
+    return numpy.concatenate(sims)
+
+
+def simulate(statistic, args, n, permutations=999, seed=12345, workers=1):
+    """
+    Evaluate a statistic under many random permutations
+
+    Parameters
+    ----------
+
+    statistic: callable
+               module-level function taking a (k, n) array of permutations
+               and `args`, returning a (k, t) array of values
+
+    args: tuple
+          further arguments of `statistic`
+
+    n: int
+       number of observations
+
+    permutations: int
+                  number of permutations
+
+    seed: int
+          seed the permutations are derived from
+
+    workers: int
+             processes to spread the permutations over, all cores if None,
+             in this process if 1
+
+    Returns
+    -------
+
+    (permutations, t) array
+    """
+    if workers == 1 or permutations <= batch_size:
+        return _shard(statistic, args, n, 0, permutations, seed)
+
+    import os
+    from concurrent.futures import ProcessPoolExecutor
+
+    workers = workers or os.cpu_count()
+    bounds = numpy.linspace(0, permutations, workers + 1).astype(int)
+    with ProcessPoolExecutor(workers) as pool:
+        jobs = [pool.submit(_shard, statistic, args, n, start, stop, seed)
+                for start, stop in zip(bounds[:-1], bounds[1:]) if stop > start]
+        return numpy.concatenate([job.result() for job in jobs])
+
+
+def folded_p(sims, observed):
+    """
+    Pseudo p-values of statistics from their simulated values, as esda
+
+    Parameters
+    ----------
+
+    sims: array
+          (permutations, ...) simulated statistics
+
+    observed: array
+              observed statistics, broadcastable to `sims[0]`
+
+    Returns
+    -------
+
+    share of simulations at least as extreme as `observed`, in the smaller
+    tail, counting the observation itself
+    """
+    larger = (sims >= observed).sum(axis=0)
+    larger = numpy.minimum(larger, len(sims) - larger)
+    return (larger + 1.0) / (len(sims) + 1.0)
+
+
+def _z(observed, sims):
+    from scipy import stats
+
+    with numpy.errstate(divide='ignore', invalid='ignore'):
+        z = (observed - sims.mean(axis=0)) / sims.std(axis=0)
+    return z, numpy.where(z > 0, stats.norm.sf(z), stats.norm.cdf(z))
+
+
+def _cross_products(perms, z, a):
+    # sum_i z_i (W z)_i for every permutation and column, with the
+    # permuted columns of the whole batch side by side in one product
+    k, n = perms.shape
+    t = z.shape[1]
+    zp = z[perms.T].reshape(n, k * t)
+    return numpy.asarray((zp * (a @ zp)).sum(axis=0)).reshape(k, t)
+
+
+def moran(y, w, transformation='r', permutations=999, seed=12345, workers=1):
+    """
+    Global Moran's I of every column of a table
+
+    Parameters
+    ----------
+
+    y: array, DataFrame
+       (n, t) values, one column per variable or period
+
+    w: libpysal W
+       spatial weights, left untouched
+
+    transformation: string
+                    'r' (row standardized), 'b' (binary) or None (as is)
+
+    permutations: int
+                  number of permutations shared by all columns
+
+    seed: int
+          seed of the permutations
+
+    workers: int
+             processes to spread the permutations over (see `simulate`)
+
+    Returns
+    -------
+
+    pandas DataFrame with one row per column and the `I`, `EI_sim`,
+    `seI_sim`, `z_sim`, `p_sim` and `p_z_sim` of esda.Moran
+
+    Examples
+    --------
+
+    >>> years = [str(year) for year in range(1969, 2018)]
+    >>> moran(pci_df[years], wq, permutations=9999, workers=None)
+    """
+    import pandas
+
+    index = getattr(y, 'columns', None)
+    z = _matrix(y)
+    z = z - z.mean(axis=0)
+    a = sparse_weights(w, transformation)
+    n = len(z)
+    scale = n / a.sum() / (z * z).sum(axis=0)
+
+    observed = (z * (a @ z)).sum(axis=0) * scale
+    table = {'I': observed}
+    if permutations:
+        sims = simulate(_cross_products, (z, a), n, permutations, seed, workers) * scale
+        table['EI_sim'] = sims.mean(axis=0)
+        table['seI_sim'] = sims.std(axis=0)
+        table['z_sim'], table['p_z_sim'] = _z(observed, sims)
+        table['p_sim'] = folded_p(sims, observed)
+    return pandas.DataFrame(table, index=index)
+
+
+def _neighbor_differences(perms, x, rows, cols):
+    # sum of absolute differences over the neighbor pairs of every
+    # permutation, for all columns at once
+    return numpy.stack([numpy.abs(x[p[rows]] - x[p[cols]]).sum(axis=0) for p in perms])
+
+
+def gini_spatial(y, w, permutations=999, seed=12345, workers=1):
+    """
+    Spatial Gini coefficient of every column of a table
+
+    Parameters
+    ----------
+
+    y: array, DataFrame
+       (n, t) values, one column per variable or period
+
+    w: libpysal W
+       spatial weights, only which pairs are neighbors is used
+
+    permutations: int
+                  number of permutations shared by all columns
+
+    seed: int
+          seed of the permutations
+
+    workers: int
+             processes to spread the permutations over (see `simulate`)
+
+    Returns
+    -------
+
+    pandas DataFrame with one row per column and the `g`, `wg`, `wcg`,
+    `wcg_share`, `polarization`, `e_wcg`, `s_wcg`, `z_wcg`, `p_sim`,
+    `p_z_sim` and `polarization_p_sim` of inequality.gini.Gini_Spatial
+    """
+    import pandas
+    from scipy import stats
+
+    from bookinequality import gini
+
+    index = getattr(y, 'columns', None)
+    x = _matrix(y)
+    n = len(x)
+    rows, cols = sparse_weights(w).nonzero()
+
+    g = gini(x)
+    den = x.mean(axis=0) * 2 * n**2
+    d = g * den
+    wg = _neighbor_differences([numpy.arange(n)], x, rows, cols)[0]
+    wcg = d - wg
+    n_pairs = n * (n - 1) / 2
+    n_n_pairs = len(rows) / 2
+    scale = n_n_pairs / (n_pairs - n_n_pairs)
+    table = {'g': g, 'wg': wg, 'wcg': wcg, 'wcg_share': wcg / den,
+             'polarization': wcg / wg * scale}
+    if permutations:
+        sims = d - simulate(_neighbor_differences, (x, rows, cols), n,
+                            permutations, seed, workers)
+        table['e_wcg'] = sims.mean(axis=0)
+        table['s_wcg'] = sims.std(axis=0)
+        table['z_wcg'] = (wcg - table['e_wcg']) / table['s_wcg']
+        table['p_sim'] = folded_p(sims, wcg)
+        table['p_z_sim'] = stats.norm.sf(table['z_wcg'])
+        polarization = sims / (d - sims) * scale
+        table['polarization_p_sim'] = ((polarization >= table['polarization']).sum(axis=0)
+                                       + 1.0) / (permutations + 1.0)
+    return pandas.DataFrame(table, index=index)
+
+
+# ## Local statistics
+#
+# Conditional randomization keeps observation i in place and draws its
+# neighbors at random among the other n - 1. Observations with the same
+# number of neighbors k share one (permutations, k) draw of positions among
+# "the others", which each observation maps onto its own others, so the
+# simulated lags of a whole chunk are one gather and one product. Draws are
+# seeded with `(seed, k)` and only summaries of the simulations are kept.
+
+
+def _draws(n, k, permutations, rng):
+    """
+    (permutations, k) array of rows of k distinct integers below n.
+    """
+    if 4 * k > n:
+        return numpy.stack([rng.permutation(n)[:k] for _ in range(permutations)])
+    draws = rng.integers(0, n, size=(permutations, k))
+    while True:
+        ordered = numpy.sort(draws, axis=1)
+        repeated = (ordered[:, 1:] == ordered[:, :-1]).any(axis=1)
+        if not repeated.any():
+            return draws
+        draws[repeated] = rng.integers(0, n, size=(repeated.sum(), k))
+
+
+def _conditional_shard(values, a, offset, scale, observed, tasks):
+    results = []
+    for members, draws in tasks:
+        k = draws.shape[1]
+        # position j among the others of i is j itself below i, j + 1 above
+        ids = draws[None] + (draws[None] >= members[:, None, None])
+        weights = a.data[a.indptr[members][:, None] + numpy.arange(k)]
+        lags = numpy.einsum('mpk,mk->mp', values[ids], weights)
+        sims = (lags + offset[members, None]) * scale[members, None]
+        larger = (sims >= observed[members, None]).sum(axis=1)
+        results.append((members, larger, sims.mean(axis=1), sims.std(axis=1)))
+    return results
+
+
+def conditional_randomization(values, a, scale, observed, offset=None,
+                              permutations=999, seed=12345, workers=1):
+    """
+    Pseudo p-values and moments of a local statistic under conditional
+    randomization
+
+    The statistic of observation i is `scale[i] * (offset[i] + sum_j
+    a[i, j] * values[j])` over its neighbors j.
+
+    Parameters
+    ----------
+
+    values: array
+            (n,) values that are drawn for the neighbors
+
+    a: scipy.sparse matrix
+       (n, n) spatial weights without self weights
+
+    scale: array
+           (n,) factor of every statistic
+
+    observed: array
+              (n,) observed statistics
+
+    offset: array
+            (n,) part of every statistic that does not depend on the
+            neighbors, such as the self weight term of G*
+
+    permutations: int
+                  number of draws for every observation
+
+    seed: int
+          seed of the draws
+
+    workers: int
+             processes to spread the observations over, all cores if None,
+             in this process if 1
+
+    Returns
+    -------
+
+    p_sim, mean, std: (n,) arrays, NaN for observations without neighbors
+    """
+    n = len(values)
+    offset = numpy.zeros(n) if offset is None else offset
+    cardinalities = numpy.diff(a.indptr)
+    tasks = []
+    for k in numpy.unique(cardinalities[cardinalities > 0]):
+        rng = numpy.random.default_rng((seed, int(k)))
+        draws = _draws(n - 1, k, permutations, rng)
+        members = numpy.flatnonzero(cardinalities == k)
+        step = max(1, chunk_size // (permutations * k))
+        tasks.extend((members[i:i + step], draws) for i in range(0, len(members), step))
+
+    args = (values, a, offset, scale, observed)
+    if workers == 1 or len(tasks) == 1:
+        results = _conditional_shard(*args, tasks)
+    else:
+        import os
+        from concurrent.futures import ProcessPoolExecutor
+
+        workers = workers or os.cpu_count()
+        with ProcessPoolExecutor(workers) as pool:
+            jobs = [pool.submit(_conditional_shard, *args, tasks[i::workers])
+                    for i in range(min(workers, len(tasks)))]
+            results = [result for job in jobs for result in job.result()]
+
+    larger, mean, std = numpy.full((3, n), numpy.nan)
+    for members, *summaries in results:
+        larger[members], mean[members], std[members] = summaries
+    larger = numpy.minimum(larger, permutations - larger)
+    return (larger + 1.0) / (permutations + 1.0), mean, std
+
+
+def _without_diagonal(a):
+    a = a.tolil()
+    a.setdiag(0)
+    a = a.tocsr()
+    a.eliminate_zeros()
+    return a
+
+
+def moran_local(y, w, transformation='r', permutations=999, seed=12345,
+                workers=1, geoda_quads=False):
+    """
+    Local Moran's I with conditional randomization
+
+    Parameters
+    ----------
+
+    y: array, Series
+       (n,) values
+
+    w: libpysal W
+       spatial weights, left untouched
+
+    transformation: string
+                    'r' (row standardized), 'b' (binary) or None (as is)
+
+    permutations: int
+                  number of draws for every observation
+
+    seed: int
+          seed of the draws
+
+    workers: int
+             processes to spread the observations over (see
+             `conditional_randomization`)
+
+    geoda_quads: Boolean
+                 number the quadrants as GeoDa does (True), or as esda (False)
+
+    Returns
+    -------
+
+    pandas DataFrame with one row per observation and the `Is`, `q`,
+    `EI_sim`, `seI_sim`, `z_sim`, `p_sim` and `p_z_sim` of
+    esda.Moran_Local. `Is` and `q` are identical; the simulated values
+    depend on the draws.
+
+    Examples
+    --------
+
+    >>> lisa = moran_local(db['Pct_Leave'], w, permutations=9999, workers=None)
+    >>> (lisa.p_sim < 0.05).sum()
+    """
+    import pandas
+    from scipy import stats
+
+    index = getattr(y, 'index', None)
+    z = numpy.asarray(y, dtype=float).ravel()
+    z = z - z.mean()
+    with numpy.errstate(all='ignore'):
+        z = z / z.std()
+    n = len(z)
+    a = sparse_weights(w, transformation)
+    lag = a @ z
+    scale = (n - 1) * z / (z * z).sum()
+    observed = scale * lag
+
+    quads = [1, 3, 2, 4] if geoda_quads else [1, 2, 3, 4]
+    high, high_lag = z > 0, lag > 0
+    q = numpy.select([high & high_lag, ~high & high_lag, ~high & ~high_lag],
+                     quads[:3], quads[3])
+    table = {'Is': observed, 'q': q}
+    if permutations:
+        diagonal = a.diagonal()
+        a = _without_diagonal(a)
+        p_sim, mean, std = conditional_randomization(z, a, scale, observed, diagonal * z,
+                                                     permutations, seed, workers)
+        table['EI_sim'], table['seI_sim'] = mean, std
+        with numpy.errstate(divide='ignore', invalid='ignore'):
+            table['z_sim'] = (observed - mean) / std
+        table['p_sim'] = p_sim
+        table['p_z_sim'] = stats.norm.sf(numpy.abs(table['z_sim']))
+    return pandas.DataFrame(table, index=index)
+
+
+def g_local(y, w, transformation='r', star=False, permutations=999, seed=12345,
+            workers=1):
+    """
+    Getis and Ord's local G with conditional randomization
+
+    Parameters
+    ----------
+
+    y: array, Series
+       (n,) values
+
+    w: libpysal W
+       spatial weights, left untouched
+
+    transformation: string
+                    'r' (row standardized) or 'b' (binary)
+
+    star: Boolean
+          include each observation in its own neighborhood (G*)
+
+    permutations: int
+                  number of draws for every observation
+
+    seed: int
+          seed of the draws
+
+    workers: int
+             processes to spread the observations over (see
+             `conditional_randomization`)
+
+    Returns
+    -------
+
+    pandas DataFrame with one row per observation and the `Gs`, `EGs`,
+    `VGs`, `Zs`, `p_norm`, `EG_sim`, `seG_sim`, `z_sim`, `p_sim` and
+    `p_z_sim` of esda.G_Local. The analytical values are identical; the
+    simulated values depend on the draws.
+    """
+    import pandas
+    from scipy import stats
+
+    index = getattr(y, 'index', None)
+    y = numpy.asarray(y, dtype=float).ravel()
+    n = len(y)
+    a = sparse_weights(w, transformation, star=star)
+    remove_self = not star
+    total = y.sum() - y * remove_self
+    observed = (a @ y) / total
+
+    m = n - remove_self
+    mean = total / m
+    variance = ((y ** 2).sum() - y ** 2 * remove_self) / m - mean ** 2
+    cardinality = numpy.asarray(a.sum(axis=1)).ravel()
+    expected = cardinality / m
+    expected_variance = (cardinality * (m - cardinality) / (m - 1) / m ** 2
+                         * variance / mean ** 2)
+    table = {'Gs': observed, 'EGs': expected, 'VGs': expected_variance}
+    table['Zs'] = (observed - expected) / numpy.sqrt(expected_variance)
+    table['p_norm'] = stats.norm.sf(numpy.abs(table['Zs']))
+    if permutations:
+        diagonal = a.diagonal()
+        a = _without_diagonal(a)
+        p_sim, mean, std = conditional_randomization(y, a, 1 / total, observed, diagonal * y,
+                                                     permutations, seed, workers)
+        table['EG_sim'], table['seG_sim'] = mean, std
+        with numpy.errstate(divide='ignore', invalid='ignore'):
+            table['z_sim'] = (observed - mean) / std
+        table['p_sim'] = p_sim
+        table['p_z_sim'] = stats.norm.sf(numpy.abs(table['z_sim']))
+    return pandas.DataFrame(table, index=index)
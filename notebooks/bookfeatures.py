@@ -0,0 +1,190 @@
+import numpy
+
+
+# distance based features for point tables
+#
+# Counts and summaries of the points around every observation are computed
+# from a KD-tree over the coordinates, in chunks of observations, instead of
+# buffering polygons or building one DistanceBand W per threshold. Memory
+# grows with the number of pairs found for one chunk, not with the square of
+# the number of points.
+
+# observations queried against the tree at once
+chunk_size = 10000
+
+statistics = ['count', 'sum', 'mean', 'std', 'min', 'max']
+
+
+def coordinates(points):
+    """
+    Coordinates of points, as an array
+
+    Parameters
+    ----------
+
+    points: GeoDataFrame, GeoSeries, array
+            (n,) points, or (n, 2) coordinates
+
+    Returns
+    -------
+
+    (n, 2) float array
+    """
+    import shapely
+
+    geometry = getattr(points, 'geometry', None)
+    if geometry is None:
+        return numpy.asarray(points, dtype=float)
+    geometry = geometry.values
+    if not (shapely.get_type_id(geometry) == 0).all():
+        raise ValueError('distance features need point geometries')
+    return numpy.column_stack([shapely.get_x(geometry), shapely.get_y(geometry)])
+
+
+def count_within(points, targets, radius):
+    """
+    Number of targets within a distance of every point
+
+    Equivalent to counting a spatial join of `targets` within
+    `points.buffer(radius)`, without building the buffers. Distances are
+    exact, so targets right at the edge of the polygonal buffers can count
+    differently.
+
+    Parameters
+    ----------
+
+    points: GeoDataFrame, GeoSeries, array
+            (n,) points, or (n, 2) coordinates
+
+    targets: GeoDataFrame, GeoSeries, array
+             points to count, in the same CRS as `points`
+
+    radius: float
+            distance in the units of the CRS
+
+    Returns
+    -------
+
+    pandas Series of counts, indexed as `points`
+
+    Examples
+    --------
+
+    >>> airbnbs_albers['poi_count'] = count_within(airbnbs_albers, pois_albers, 500)
+    """
+    import pandas
+    from scipy.spatial import cKDTree
+
+    tree = cKDTree(coordinates(targets))
+    counts = tree.query_ball_point(coordinates(points), r=radius, return_length=True)
+    return pandas.Series(counts, index=getattr(points, 'index', None), name='count')
+
+
+def ring_features(points, bands, values=None, targets=None, stats=('count', 'mean')):
+    """
+    Counts and summaries of the points in successive distance rings
+
+    Ring k holds the targets further than `bands[k - 1]` and at most
+    `bands[k]` away (the first starts at 0), so with `bands=[500, 1000]`
+    the rings are the 500m neighborhood and the 500m-1km annulus.
+
+    Parameters
+    ----------
+
+    points: GeoDataFrame, GeoSeries, array
+            (n,) points, or (n, 2) coordinates
+
+    bands: list
+           increasing outer distances of the rings
+
+    values: DataFrame, Series, array
+            (m,) or (m, p) values of the targets to summarize
+
+    targets: GeoDataFrame, GeoSeries, array
+             (m,) points to summarize, `points` themselves if None, in which
+             case each point is left out of its own rings
+
+    stats: list
+           statistics of `values` in every ring, out of `statistics`;
+           'count' counts the targets
+
+    Returns
+    -------
+
+    pandas DataFrame indexed as `points` with a `count_<inner>_<outer>`
+    column per ring and a `<value>_<stat>_<inner>_<outer>` column per value,
+    statistic and ring; in empty rings, sums are 0 and the other summaries
+    NaN
+
+    Examples
+    --------
+
+    >>> rings = ring_features(airbnbs_albers, [500, 1000],
+    ...                       airbnbs_albers[['bedrooms']])
+    >>> rings['bedrooms_mean_500_1000']
+    """
+    import pandas
+    from scipy.spatial import cKDTree
+
+    bands = numpy.asarray(bands, dtype=float)
+    if (numpy.diff(bands) <= 0).any():
+        raise ValueError('bands must be increasing')
+    unknown = set(stats) - set(statistics)
+    if unknown:
+        raise ValueError('unknown statistics: %s' % sorted(unknown))
+
+    xy = coordinates(points)
+    same = targets is None
+    tree = cKDTree(xy if same else coordinates(targets))
+    n, k = len(xy), len(bands)
+    if values is None:
+        names, y = [], numpy.empty((tree.n, 0))
+    else:
+        frame = pandas.DataFrame(values)
+        if isinstance(frame.columns, pandas.RangeIndex):
+            # unnamed arrays
+            frame.columns = ['value'] if frame.shape[1] == 1 else \
+                ['value%d' % c for c in frame.columns]
+        names = [str(c) for c in frame.columns]
+        y = frame.to_numpy(dtype=float)
+    p = y.shape[1]
+
+    count = numpy.zeros((n, k))
+    total, squares = numpy.zeros((2, p, n * k))
+    low = numpy.full((p, n * k), numpy.inf)
+    high = numpy.full((p, n * k), -numpy.inf)
+    for start in range(0, n, chunk_size):
+        stop = min(start + chunk_size, n)
+        pairs = cKDTree(xy[start:stop]).sparse_distance_matrix(
+            tree, bands[-1], output_type='ndarray')
+        i, j, d = pairs['i'] + start, pairs['j'], pairs['v']
+        if same:
+            i, j, d = i[i != j], j[i != j], d[i != j]
+        cell = i * k + numpy.searchsorted(bands, d, side='left')
+        count.ravel()[:] += numpy.bincount(cell, minlength=n * k)
+        for c in range(p):
+            total[c] += numpy.bincount(cell, y[j, c], minlength=n * k)
+            squares[c] += numpy.bincount(cell, y[j, c] ** 2, minlength=n * k)
+            numpy.minimum.at(low[c], cell, y[j, c])
+            numpy.maximum.at(high[c], cell, y[j, c])
+
+    inner = numpy.concatenate([[0], bands[:-1]])
+    rings = ['%g_%g' % (a, b) for a, b in zip(inner, bands)]
+    columns = {}
+    if 'count' in stats:
+        columns.update(('count_' + ring, count[:, r]) for r, ring in enumerate(rings))
+    flat = count.ravel()
+    with numpy.errstate(divide='ignore', invalid='ignore'):
+        for c, name in enumerate(names):
+            mean = total[c] / flat
+            summaries = {'sum': total[c], 'mean': mean,
+                         'std': numpy.sqrt(numpy.maximum(squares[c] / flat - mean ** 2, 0)),
+                         'min': numpy.where(flat > 0, low[c], numpy.nan),
+                         'max': numpy.where(flat > 0, high[c], numpy.nan)}
+            for stat in stats:
+                if stat == 'count':
+                    continue
+                matrix = summaries[stat].reshape(n, k)
+                columns.update(('%s_%s_%s' % (name, stat, ring), matrix[:, r])
+                               for r, ring in enumerate(rings))
+    return pandas.DataFrame(columns, index=getattr(points, 'index', None))
@@ -0,0 +1,160 @@
+import numpy
+
+
+# inequality indices for many periods at once
+#
+# Every function takes an (n_regions, n_periods) array, or a DataFrame with
+# one column per period, and works on all columns in a single pass over
+# one column-wise sort of the values.
+
+SMALL = numpy.finfo('float').tiny
+
+
+def _matrix(y):
+    y = numpy.asarray(y, dtype=float)
+    if y.ndim == 1:
+        y = y[:, None]
+    return y
+
+
+def _sorted(y):
+    return numpy.sort(_matrix(y), axis=0)
+
+
+def _ratio_20_20(ys):
+    # a sorted column is its own quantile function, so interpolate directly
+    position = numpy.array([.8, .2]) * (len(ys) - 1)
+    below = numpy.floor(position).astype(int)
+    above = numpy.minimum(below + 1, len(ys) - 1)
+    weight = (position - below)[:, None]
+    top, bottom = ys[below] * (1 - weight) + ys[above] * weight
+    return top / bottom
+
+
+def _gini(ys):
+    n = len(ys)
+    total = ys.sum(axis=0)
+    ranked = 2.0 * numpy.arange(1, n + 1) @ ys
+    return (ranked - (n + 1) * total) / (n * total)
+
+
+def _theil(y):
+    y = y + SMALL * (y == 0)
+    shares = y / y.sum(axis=0)
+    return (shares * numpy.log(len(y) * shares)).sum(axis=0)
+
+
+def ratio_20_20(y):
+    """
+    Ratio of the 80th over the 20th percentile of every column
+
+    Parameters
+    ----------
+
+    y: array, DataFrame
+       (n, t) values, one column per period
+
+    Returns
+    -------
+
+    (t,) array
+    """
+    return _ratio_20_20(_sorted(y))
+
+
+def lorenz(y):
+    """
+    Lorenz curves of every column
+
+    Parameters
+    ----------
+
+    y: array, DataFrame
+       (n, t) values, one column per period
+
+    Returns
+    -------
+
+    population_shares: (n,) array of the cumulative share of regions
+
+    income_shares: (n, t) array of the cumulative share of the column total
+                   held by the poorest regions
+    """
+    ys = _sorted(y)
+    n = len(ys)
+    return numpy.arange(1, n + 1) / n, ys.cumsum(axis=0) / ys.sum(axis=0)
+
+
+def gini(y):
+    """
+    Gini coefficient of every column, as `inequality.gini.Gini(column).g`
+
+    Parameters
+    ----------
+
+    y: array, DataFrame
+       (n, t) values, one column per period
+
+    Returns
+    -------
+
+    (t,) array
+    """
+    return _gini(_sorted(y))
+
+
+def theil(y):
+    """
+    Theil's T of every column, as `inequality.theil.Theil(column).T`
+
+    Parameters
+    ----------
+
+    y: array, DataFrame
+       (n, t) values, one column per period
+
+    Returns
+    -------
+
+    (t,) array
+    """
+    return _theil(_matrix(y))
+
+
+def indices(y, periods=None):
+    """
+    20:20 ratio, Gini and Theil's T for every column of a table
+
+    Parameters
+    ----------
+
+    y: array, DataFrame
+       (n, t) values, one column per period
+
+    periods: list
+             labels of the t columns, the DataFrame columns or 0..t-1 by
+             default (None)
+
+    Returns
+    -------
+
+    pandas DataFrame indexed by period with columns `ratio_20_20`, `gini`
+    and `theil`
+
+    Examples
+    --------
+
+    >>> years = [str(year) for year in range(1969, 2018)]
+    >>> indices(pci_df[years]).plot(subplots=True)
+    """
+    import pandas
+
+    if periods is None:
+        periods = getattr(y, 'columns', None)
+    ys = _sorted(y)
+    table = pandas.DataFrame({'ratio_20_20': _ratio_20_20(ys),
+                              'gini': _gini(ys),
+                              'theil': _theil(ys)},
+                             index=periods)
+    table.index.name = 'period'
+    return table
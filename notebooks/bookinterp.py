@@ -0,0 +1,169 @@
+import os
+
+import numpy
+
+import bookdata
+
+
+# areal interpolation from a cached source x target overlap matrix
+#
+# How much of every source polygon falls in every target is computed once,
+# from a single bulk STRtree query and vectorized intersections, and stored
+# as a sparse (n_source, n_target) matrix of intersection areas. Moving any
+# number of columns from the source to the target is then one sparse product.
+# Matrices are cached in memory and under `cachepath` (`.npz`), named by the
+# `bookdata.fingerprint` of both tables.
+
+cachepath = os.path.join(bookdata.cachepath, 'interpolation')
+
+# geometries intersected at once by each thread
+chunk_size = 10000
+
+
+def _intersection_areas(a, b):
+    import shapely
+
+    return shapely.area(shapely.intersection(a, b))
+
+
+def overlap(source, target, workers=4, refresh=False):
+    """
+    Sparse matrix of the area every source polygon shares with every target
+
+    For point targets, the matrix flags the source polygon each point
+    intersects instead (the first one, for points on a boundary or where
+    polygons overlap).
+
+    Parameters
+    ----------
+
+    source: geopandas GeoDataFrame or GeoSeries
+            polygons with the data
+
+    target: geopandas GeoDataFrame or GeoSeries
+            polygons or points to move the data to, in the same CRS
+
+    workers: int
+             threads computing the intersections
+
+    refresh: Boolean
+             compute the matrix again even if it is cached (True)
+
+    Returns
+    -------
+
+    (n_source, n_target) scipy.sparse CSR matrix
+    """
+    if source.crs != target.crs:
+        raise ValueError('source and target must be in the same CRS')
+    key = bookdata.fingerprint(source, bookdata.fingerprint(target))
+    path = os.path.join(cachepath, 'overlap-%s.npz' % key[:16])
+    return bookdata.cached_matrix(path, lambda: _overlap(source, target, workers), refresh)
+
+
+def _overlap(source, target, workers):
+    import concurrent.futures
+
+    import scipy.sparse
+    import shapely
+
+    sources, targets = source.geometry.values, target.geometry.values
+    tree = shapely.STRtree(sources)
+    if (shapely.get_type_id(targets) == 0).all():
+        t, s = tree.query(targets, predicate='intersects')
+        t, first = numpy.unique(t, return_index=True)
+        s, values = s[first], numpy.ones(len(t))
+    else:
+        t, s = tree.query(targets, predicate='intersects')
+        bounds = range(0, len(t), chunk_size)
+        with concurrent.futures.ThreadPoolExecutor(workers) as pool:
+            values = numpy.concatenate([numpy.empty(0)] + list(pool.map(
+                lambda start: _intersection_areas(sources[s[start:start + chunk_size]],
+                                                  targets[t[start:start + chunk_size]]),
+                bounds)))
+        keep = values > 0
+        s, t, values = s[keep], t[keep], values[keep]
+    return scipy.sparse.csr_matrix((values, (s, t)), shape=(len(sources), len(targets)))
+
+
+def _values(source, columns):
+    # missing values count as 0, as in tobler
+    return numpy.nan_to_num(source[list(columns)].to_numpy(dtype=float))
+
+
+def area_interpolate(source, target, extensive=(), intensive=(), workers=4,
+                     allocate_total=True):
+    """
+    Move columns of a polygon table to other polygons or points, by area
+
+    Extensive variables (counts, totals) are split among targets by the
+    share of each source polygon they cover; intensive variables (rates,
+    densities) are averaged over the sources weighted by the area they share
+    with each target. Results match `tobler.area_weighted.area_interpolate`.
+    With point targets, every point gets the intensive values of the polygon
+    it intersects, as a spatial join would, keeping the first polygon for
+    points on a boundary.
+
+    Parameters
+    ----------
+
+    source: geopandas GeoDataFrame
+            polygons with the data
+
+    target: geopandas GeoDataFrame or GeoSeries
+            polygons or points, in the same (preferably equal area) CRS
+
+    extensive: list
+               names of the extensive columns of `source`
+
+    intensive: list
+               names of the intensive columns of `source`
+
+    workers: int
+             threads computing the intersections, if not cached
+
+    allocate_total: Boolean
+                    split the whole of a source value among the targets it
+                    meets (True), or only the share of its area they cover
+                    (False)
+
+    Returns
+    -------
+
+    geopandas GeoDataFrame indexed as `target` with its geometry and the
+    interpolated columns
+
+    Examples
+    --------
+
+    >>> interpolated = area_interpolate(sd_pop.to_crs(epsg=3311),
+    ...                                 h3.to_crs(epsg=3311),
+    ...                                 extensive=['B02001_001E'],
+    ...                                 intensive=['density'])
+    """
+    import geopandas
+    import pandas
+    import scipy.sparse
+
+    matrix = overlap(source, target, workers)
+    points = (target.geometry.geom_type == 'Point').all()
+    if points and len(extensive):
+        raise ValueError('extensive variables cannot be moved to points')
+    columns = {}
+    if len(extensive):
+        if allocate_total:
+            shares = numpy.asarray(matrix.sum(axis=1)).ravel()
+        else:
+            shares = source.geometry.area.to_numpy()
+        shares = 1 / (shares + (shares == 0))
+        estimates = (scipy.sparse.diags(shares) @ matrix).T @ _values(source, extensive)
+        columns.update(zip(extensive, estimates.T))
+    if len(intensive):
+        covered = numpy.asarray(matrix.sum(axis=0)).ravel()
+        estimates = (matrix.T @ _values(source, intensive)) / (covered + (covered == 0))[:, None]
+        if points:
+            estimates[covered == 0] = numpy.nan
+        columns.update(zip(intensive, estimates.T))
+    table = pandas.DataFrame(columns, index=target.index)
+    return geopandas.GeoDataFrame(table, geometry=target.geometry.values,
+                                  crs=target.crs)
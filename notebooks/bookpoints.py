@@ -0,0 +1,556 @@
+import math
+
+import numpy
+
+
+# point patterns too large to hold in memory
+#
+# Points are read in chunks, from a CSV or an in-memory table, and counted
+# into a fixed grid as they stream through; everything downstream (maps,
+# densities) works on the grid, so memory and time depend on the grid size
+# and not on the number of points. Kernel densities are computed from the
+# binned counts by FFT convolution instead of evaluating every point at
+# every grid node.
+
+# rows read at once from a CSV
+chunk_size = 10 ** 6
+
+
+def _chunks(source, x='x', y='y', chunksize=None):
+    """
+    Stream of (m, 2) coordinate arrays out of a CSV path, a table or an array
+    """
+    import pandas
+
+    chunksize = chunksize or chunk_size
+    if isinstance(source, str):
+        for chunk in pandas.read_csv(source, usecols=[x, y], chunksize=chunksize):
+            xy = chunk[[x, y]].to_numpy(dtype=float)
+            yield xy[~numpy.isnan(xy).any(axis=1)]
+        return
+    if isinstance(source, pandas.DataFrame):
+        source = source[[x, y]]
+    xy = numpy.asarray(source, dtype=float)
+    for start in range(0, len(xy), chunksize):
+        part = xy[start:start + chunksize]
+        yield part[~numpy.isnan(part).any(axis=1)]
+
+
+def extent(source, x='x', y='y', chunksize=None):
+    """
+    Bounds of a set of points, read in chunks
+
+    Parameters
+    ----------
+
+    source: string, DataFrame, array
+            path to a CSV, table with coordinate columns, or (n, 2) array
+
+    x, y: string
+          names of the coordinate columns
+
+    chunksize: int
+               rows read at once, `chunk_size` if None
+
+    Returns
+    -------
+
+    (xmin, xmax, ymin, ymax) tuple, as `extent` in matplotlib
+    """
+    low = numpy.full(2, numpy.inf)
+    high = numpy.full(2, -numpy.inf)
+    for xy in _chunks(source, x, y, chunksize):
+        if len(xy):
+            low = numpy.minimum(low, xy.min(axis=0))
+            high = numpy.maximum(high, xy.max(axis=0))
+    return float(low[0]), float(high[0]), float(low[1]), float(high[1])
+
+
+def histogram(source, bounds=None, gridsize=100, x='x', y='y', chunksize=None):
+    """
+    Counts of points in a regular grid of square cells
+
+    Parameters
+    ----------
+
+    source: string, DataFrame, array
+            path to a CSV, table with coordinate columns, or (n, 2) array
+
+    bounds: tuple
+            (xmin, xmax, ymin, ymax) covered by the grid, the extent of the
+            points (an extra pass over them) if None; points outside are
+            left out
+
+    gridsize: int, tuple
+              cells along each axis, or (nx, ny)
+
+    x, y: string
+          names of the coordinate columns
+
+    chunksize: int
+               rows read at once, `chunk_size` if None
+
+    Returns
+    -------
+
+    counts: (ny, nx) array, the first row at `ymin`
+
+    bounds: (xmin, xmax, ymin, ymax) of the grid
+
+    Examples
+    --------
+
+    >>> counts, bounds = histogram('../data/tokyo/tokyo_clean.csv', gridsize=200)
+    >>> plt.imshow(counts, origin='lower', extent=bounds)
+    """
+    if bounds is None:
+        bounds = extent(source, x, y, chunksize)
+    nx, ny = gridsize if numpy.iterable(gridsize) else (gridsize, gridsize)
+    xmin, xmax, ymin, ymax = bounds
+    dx, dy = (xmax - xmin) / nx, (ymax - ymin) / ny
+    counts = numpy.zeros(nx * ny)
+    for xy in _chunks(source, x, y, chunksize):
+        xy = xy[(xy[:, 0] >= xmin) & (xy[:, 0] <= xmax)
+                & (xy[:, 1] >= ymin) & (xy[:, 1] <= ymax)]
+        # points on the upper edges go in the last cells, as numpy.histogram2d
+        ix = numpy.minimum(((xy[:, 0] - xmin) / dx).astype(int), nx - 1)
+        iy = numpy.minimum(((xy[:, 1] - ymin) / dy).astype(int), ny - 1)
+        counts += numpy.bincount(iy * nx + ix, minlength=nx * ny)
+    return counts.reshape(ny, nx), tuple(bounds)
+
+
+def hexbin(source, bounds=None, gridsize=100, x='x', y='y', chunksize=None):
+    """
+    Counts of points in a grid of hexagons, laid out as `Axes.hexbin`
+
+    Parameters
+    ----------
+
+    source: string, DataFrame, array
+            path to a CSV, table with coordinate columns, or (n, 2) array
+
+    bounds: tuple
+            (xmin, xmax, ymin, ymax) covered by the grid, the extent of the
+            points (an extra pass over them) if None
+
+    gridsize: int, tuple
+              hexagons along x, or (nx, ny), as in `Axes.hexbin`
+
+    x, y: string
+          names of the coordinate columns
+
+    chunksize: int
+               rows read at once, `chunk_size` if None
+
+    Returns
+    -------
+
+    pandas DataFrame with the `x` and `y` centers and the `count` of every
+    hexagon; passing them back to `Axes.hexbin` with the same `gridsize` and
+    `extent=bounds`, `C=count` and `reduce_C_function=numpy.sum` draws the
+    same map as `hexbin` on all the points
+
+    Examples
+    --------
+
+    >>> bounds = extent('../data/tokyo/tokyo_clean.csv')
+    >>> cells = hexbin('../data/tokyo/tokyo_clean.csv', bounds, gridsize=50)
+    >>> hb = ax.hexbin(cells['x'], cells['y'], C=cells['count'],
+    ...                reduce_C_function=numpy.sum, gridsize=50, extent=bounds)
+    """
+    import pandas
+
+    if bounds is None:
+        bounds = extent(source, x, y, chunksize)
+    if numpy.iterable(gridsize):
+        nx, ny = gridsize
+    else:
+        nx, ny = gridsize, int(gridsize / math.sqrt(3))
+    xmin, xmax, ymin, ymax = bounds
+    # same lattices and rounding as matplotlib: one of hexagons centered on
+    # the integer positions, another on the half positions
+    padding = 1e-9 * (xmax - xmin)
+    xmin, xmax = xmin - padding, xmax + padding
+    sx, sy = (xmax - xmin) / nx, (ymax - ymin) / ny
+    nx1, ny1 = nx + 1, ny + 1
+    counts1 = numpy.zeros(nx1 * ny1 + 1)
+    counts2 = numpy.zeros(nx * ny + 1)
+    for xy in _chunks(source, x, y, chunksize):
+        ix = (xy[:, 0] - xmin) / sx
+        iy = (xy[:, 1] - ymin) / sy
+        ix1, iy1 = numpy.round(ix).astype(int), numpy.round(iy).astype(int)
+        ix2, iy2 = numpy.floor(ix).astype(int), numpy.floor(iy).astype(int)
+        # out of range points go to position 0 and are dropped
+        i1 = numpy.where((0 <= ix1) & (ix1 < nx1) & (0 <= iy1) & (iy1 < ny1),
+                         ix1 * ny1 + iy1 + 1, 0)
+        i2 = numpy.where((0 <= ix2) & (ix2 < nx) & (0 <= iy2) & (iy2 < ny),
+                         ix2 * ny + iy2 + 1, 0)
+        first = (ix - ix1) ** 2 + 3 * (iy - iy1) ** 2 < \
+            (ix - ix2 - .5) ** 2 + 3 * (iy - iy2 - .5) ** 2
+        counts1 += numpy.bincount(i1[first], minlength=len(counts1))
+        counts2 += numpy.bincount(i2[~first], minlength=len(counts2))
+
+    centers = numpy.concatenate([
+        numpy.column_stack([numpy.repeat(numpy.arange(nx1), ny1),
+                            numpy.tile(numpy.arange(ny1), nx1)]),
+        numpy.column_stack([numpy.repeat(numpy.arange(nx) + .5, ny),
+                            numpy.tile(numpy.arange(ny), nx) + .5])])
+    return pandas.DataFrame({'x': centers[:, 0] * sx + xmin,
+                             'y': centers[:, 1] * sy + ymin,
+                             'count': numpy.concatenate([counts1[1:], counts2[1:]])})
+
+
+def cell_centers(bounds, shape):
+    """
+    x and y coordinates of the centers of the columns and rows of a grid
+
+    Parameters
+    ----------
+
+    bounds: tuple
+            (xmin, xmax, ymin, ymax) of the grid
+
+    shape: tuple
+           (ny, nx) cells
+
+    Returns
+    -------
+
+    xs: (nx,) array
+
+    ys: (ny,) array
+    """
+    xmin, xmax, ymin, ymax = bounds
+    ny, nx = shape
+    dx, dy = (xmax - xmin) / nx, (ymax - ymin) / ny
+    return xmin + dx * (numpy.arange(nx) + .5), ymin + dy * (numpy.arange(ny) + .5)
+
+
+def kde(counts, bounds, bandwidth='scott'):
+    """
+    Gaussian kernel density of binned points, by FFT convolution
+
+    Every point is taken at the center of its cell, so the result is
+    `scipy.stats.gaussian_kde` evaluated at the cell centers up to the size
+    of the cells, and costs O(cells log cells) however many points were
+    binned.
+
+    Parameters
+    ----------
+
+    counts: array
+            (ny, nx) counts of points, from `histogram`
+
+    bounds: tuple
+            (xmin, xmax, ymin, ymax) of the grid
+
+    bandwidth: string, float
+               'scott', 'silverman' or a scalar factor applied to the
+               covariance of the points, as `bw_method` in `gaussian_kde`
+
+    Returns
+    -------
+
+    (ny, nx) array of densities at the cell centers
+
+    Examples
+    --------
+
+    >>> counts, bounds = histogram('../data/tokyo/tokyo_clean.csv', gridsize=200)
+    >>> density = kde(counts, bounds)
+    >>> plt.contourf(*cell_centers(bounds, density.shape), density, levels=50)
+    """
+    from scipy.signal import fftconvolve
+
+    counts = numpy.asarray(counts, dtype=float)
+    ny, nx = counts.shape
+    xmin, xmax, ymin, ymax = bounds
+    dx, dy = (xmax - xmin) / nx, (ymax - ymin) / ny
+    xs, ys = cell_centers(bounds, counts.shape)
+    n = counts.sum()
+    gx, gy = numpy.meshgrid(xs, ys)
+    covariance = numpy.cov(numpy.vstack([gx.ravel(), gy.ravel()]),
+                           fweights=counts.ravel().astype(int))
+    if bandwidth in ('scott', 'silverman'):
+        # the same in two dimensions
+        factor = n ** (-1 / 6)
+    else:
+        factor = float(bandwidth)
+    covariance = covariance * factor ** 2
+
+    # kernel on the cell offsets, out to four standard deviations
+    kx = min(int(math.ceil(4 * math.sqrt(covariance[0, 0]) / dx)), nx)
+    ky = min(int(math.ceil(4 * math.sqrt(covariance[1, 1]) / dy)), ny)
+    u, v = numpy.meshgrid(numpy.arange(-kx, kx + 1) * dx, numpy.arange(-ky, ky + 1) * dy)
+    offsets = numpy.stack([u, v], axis=-1)
+    distances = numpy.einsum('...i,ij,...j->...', offsets, numpy.linalg.inv(covariance), offsets)
+    kernel = numpy.exp(-distances / 2) / (2 * math.pi * math.sqrt(numpy.linalg.det(covariance)))
+
+    density = fftconvolve(counts, kernel, mode='same') / n
+    # FFT round-off leaves tiny negative values where there are no points
+    return numpy.maximum(density, 0)
+
+
+# Ripley's functions against simulations of complete spatial randomness
+#
+# Simulated pattern `i` is drawn from its own generator seeded with
+# `(seed, i)`, as the permutations in `bookesda`, so envelopes only depend
+# on the seed and not on how simulations are batched or spread over
+# processes. Every function is evaluated at all distances from one sort of
+# the nearest neighbor distances (G, F) or one dual-tree pair count (K), and
+# the lattice F is measured from is laid out once for all patterns.
+
+# simulated patterns drawn and evaluated together
+batch_size = 32
+
+functions = ['G', 'F', 'K']
+
+# points of the lattice the empty space function F is measured from
+probes = 10000
+
+
+def window(coordinates, kind='bbox'):
+    """
+    Region a point pattern is observed in
+
+    Parameters
+    ----------
+
+    coordinates: array
+                 (n, 2) coordinates of the points
+
+    kind: string
+          'bbox' for the bounding box, 'hull' for the convex hull or 'alpha'
+          for the tightest single alpha shape (`libpysal.cg.alpha_shape_auto`,
+          slow on large patterns)
+
+    Returns
+    -------
+
+    shapely Polygon
+    """
+    import shapely
+
+    coordinates = numpy.asarray(coordinates, dtype=float)
+    if kind == 'bbox':
+        return shapely.box(*coordinates.min(axis=0), *coordinates.max(axis=0))
+    if kind == 'hull':
+        return shapely.multipoints(coordinates).convex_hull
+    if kind == 'alpha':
+        from libpysal.cg import alpha_shape_auto
+        return alpha_shape_auto(coordinates)
+    raise ValueError("kind must be 'bbox', 'hull' or 'alpha'")
+
+
+def csr(region, n, start, stop, seed=12345):
+    """
+    Patterns `start` to `stop` of `n` points spread uniformly over a region
+
+    Parameters
+    ----------
+
+    region: shapely Polygon
+            window to simulate in
+
+    n: int
+       points per pattern
+
+    start, stop: int
+                 range of patterns, each drawn from a generator seeded with
+                 `(seed, i)`
+
+    seed: int
+          seed the patterns are derived from
+
+    Returns
+    -------
+
+    (stop - start, n, 2) array
+    """
+    import shapely
+
+    shapely.prepare(region)
+    xmin, ymin, xmax, ymax = region.bounds
+    coverage = region.area / ((xmax - xmin) * (ymax - ymin))
+    patterns = numpy.empty((stop - start, n, 2))
+    for p, i in enumerate(range(start, stop)):
+        rng = numpy.random.default_rng((seed, i))
+        found = 0
+        while found < n:
+            # rejection sampling from the bounding box
+            draws = int((n - found) / coverage * 1.1) + 16
+            xy = rng.uniform((xmin, ymin), (xmax, ymax), (draws, 2))
+            xy = xy[shapely.contains_xy(region, xy[:, 0], xy[:, 1])][:n - found]
+            patterns[p, found:found + len(xy)] = xy
+            found += len(xy)
+    return patterns
+
+
+def _lattice(region, size):
+    """
+    About `size` points of a square lattice within a region
+    """
+    import shapely
+
+    xmin, ymin, xmax, ymax = region.bounds
+    step = math.sqrt(region.area / size)
+    x, y = numpy.meshgrid(numpy.arange(xmin + step / 2, xmax, step),
+                          numpy.arange(ymin + step / 2, ymax, step))
+    x, y = x.ravel(), y.ravel()
+    inside = shapely.contains_xy(region, x, y)
+    return numpy.column_stack([x[inside], y[inside]])
+
+
+def _tree(xy):
+    from scipy.spatial import cKDTree
+
+    # queried once, so a quick build beats a tight tree
+    return cKDTree(xy, balanced_tree=False, compact_nodes=False)
+
+
+def _cdf(distances, support):
+    return numpy.searchsorted(numpy.sort(distances), support, side='right') / len(distances)
+
+
+def _g(patterns, support, region, lattice):
+    # second closest point, the first is the point itself
+    return numpy.stack([_cdf(_tree(xy).query(xy, k=[2])[0][:, 0], support)
+                        for xy in patterns])
+
+
+def _f(patterns, support, region, lattice):
+    return numpy.stack([_cdf(_tree(xy).query(lattice)[0], support) for xy in patterns])
+
+
+def _k(patterns, support, region, lattice):
+    k, n, _ = patterns.shape
+    pairs = numpy.empty((k, len(support)))
+    for p, xy in enumerate(patterns):
+        tree = _tree(xy)
+        # ordered pairs, less the points paired with themselves
+        pairs[p] = tree.count_neighbors(tree, support) - n
+    return region.area * pairs / (n * (n - 1))
+
+
+def _function(name):
+    return {'G': _g, 'F': _f, 'K': _k}[name]
+
+
+def _shard(name, region, n, support, lattice, start, stop, seed):
+    sims = []
+    for first in range(start, stop, batch_size):
+        patterns = csr(region, n, first, min(first + batch_size, stop), seed)
+        sims.append(_function(name)(patterns, support, region, lattice))
+    return numpy.concatenate(sims)
+
+
+def envelope(coordinates, function='G', support=40, region='bbox', simulations=999,
+             seed=12345, workers=1, keep_simulations=False):
+    """
+    Ripley's G, F or K function of a pattern and its envelope under
+    complete spatial randomness
+
+    Edges are not corrected for, as in `pointpats.distance_statistics`.
+
+    Parameters
+    ----------
+
+    coordinates: array
+                 (n, 2) coordinates of the points
+
+    function: string
+              'G' (nearest neighbor distances), 'F' (empty space distances,
+              from a lattice of about `probes` points in the region) or 'K'
+              (pairs within each distance)
+
+    support: int, array
+             distances to evaluate the function at, or their number, evenly
+             spaced from 0 to the largest observed distance (G, F) or a
+             quarter of the shorter side of the region (K)
+
+    region: string, shapely Polygon
+            window of the pattern, simulations are drawn in it; 'bbox',
+            'hull' or 'alpha' as in `window`
+
+    simulations: int
+                 number of simulated patterns
+
+    seed: int
+          seed the simulations are derived from
+
+    workers: int
+             processes to spread the simulations over, all cores if None,
+             in this process if 1
+
+    keep_simulations: Boolean
+                      return the simulated functions too (True)
+
+    Returns
+    -------
+
+    table: pandas DataFrame indexed by distance with the observed
+           `statistic`, the `low` (2.5%), `median` and `high` (97.5%)
+           simulated values and the folded pseudo p-value of the observed
+           value
+
+    simulations: (simulations, len(support)) array, with `keep_simulations`
+
+    Examples
+    --------
+
+    >>> g = envelope(coordinates, 'G', support=40)
+    >>> g['statistic'].plot(color='red')
+    >>> plt.fill_between(g.index, g['low'], g['high'], alpha=.3)
+    """
+    import pandas
+    from bookesda import folded_p
+
+    if function not in functions:
+        raise ValueError('function must be one of %s' % functions)
+    coordinates = numpy.asarray(coordinates, dtype=float)
+    n = len(coordinates)
+    if isinstance(region, str):
+        region = window(coordinates, region)
+    xmin, ymin, xmax, ymax = region.bounds
+    lattice = _lattice(region, probes) if function == 'F' else None
+
+    if function == 'K':
+        maximum = min(xmax - xmin, ymax - ymin) / 4
+    else:
+        # observed distances give both the default support and the statistic
+        tree = _tree(coordinates)
+        if function == 'G':
+            distances = tree.query(coordinates, k=[2])[0][:, 0]
+        else:
+            distances = tree.query(lattice)[0]
+        maximum = distances.max()
+    if numpy.iterable(support):
+        support = numpy.asarray(support, dtype=float)
+    else:
+        support = numpy.linspace(0, maximum, support)
+    if function == 'K':
+        observed = _k(coordinates[None], support, region, lattice)[0]
+    else:
+        observed = _cdf(distances, support)
+
+    if workers == 1 or simulations <= batch_size:
+        sims = _shard(function, region, n, support, lattice, 0, simulations, seed)
+    else:
+        import os
+        from concurrent.futures import ProcessPoolExecutor
+
+        workers = workers or os.cpu_count()
+        bounds = numpy.linspace(0, simulations, workers + 1).astype(int)
+        with ProcessPoolExecutor(workers) as pool:
+            jobs = [pool.submit(_shard, function, region, n, support, lattice,
+                                start, stop, seed)
+                    for start, stop in zip(bounds[:-1], bounds[1:]) if stop > start]
+            sims = numpy.concatenate([job.result() for job in jobs])
+
+    low, median, high = numpy.percentile(sims, [2.5, 50, 97.5], axis=0)
+    table = pandas.DataFrame({'statistic': observed, 'low': low, 'median': median,
+                              'high': high, 'pvalue': folded_p(sims, observed)},
+                             index=pandas.Index(support, name='distance'))
+    if keep_simulations:
+        return table, sims
+    return table
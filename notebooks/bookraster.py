@@ -0,0 +1,341 @@
+import collections
+import contextlib
+import threading
+
+import numpy
+
+
+# raster values at many points, read window by window
+#
+# `rasterio`'s `DatasetReader.sample` reads the raster once per coordinate.
+# Here points are sorted by the window of the raster they fall in, windows
+# are aligned with the internal blocks of the file, and each window is read
+# once for all requested bands, with values gathered for all of its points
+# by array indexing. The cost is bounded by the number of windows touched,
+# not by the number of points. Zonal statistics stream the same windows and
+# burn the polygons into each of them instead of clipping the raster once
+# per polygon.
+
+# minimum side of a read window, in pixels; windows are whole numbers of
+# blocks so striped files are not read one strip at a time
+window_size = 512
+
+# windows kept in memory across calls when sampling with `cache=True`
+cache_bytes = 2 ** 28
+_windows = collections.OrderedDict()
+
+methods = ['nearest', 'bilinear']
+
+zonal_statistics = ['count', 'sum', 'mean', 'min', 'max']
+
+
+@contextlib.contextmanager
+def _opened(source):
+    import rasterio
+
+    if isinstance(source, str):
+        with rasterio.open(source) as dataset:
+            yield dataset
+    else:
+        yield source
+
+
+def _window_shape(dataset):
+    height, width = dataset.block_shapes[0]
+    rows = -(-window_size // height) * height
+    cols = -(-window_size // width) * width
+    return min(rows, dataset.height), min(cols, dataset.width)
+
+
+def _read(dataset, bands, row, col, height, width, cache):
+    """
+    float64 (bands, height, width) values of a window, NaN where masked
+    """
+    from rasterio.windows import Window
+
+    key = (dataset.name, bands, row, col, height, width)
+    if cache and key in _windows:
+        _windows.move_to_end(key)
+        return _windows[key]
+    values = dataset.read(list(bands), window=Window(col, row, width, height),
+                          masked=True)
+    values = values.astype(float).filled(numpy.nan)
+    if cache:
+        _windows[key] = values
+        while sum(v.nbytes for v in _windows.values()) > cache_bytes and len(_windows) > 1:
+            _windows.popitem(last=False)
+    return values
+
+
+def sample(source, points, bands=None, method='nearest', cache=False):
+    """
+    Values of a raster at a set of points
+
+    Parameters
+    ----------
+
+    source: string, rasterio dataset
+            path to the raster or open dataset
+
+    points: GeoDataFrame, GeoSeries, array
+            (n,) points, reprojected to the CRS of the raster if needed, or
+            (n, 2) coordinates in the CRS of the raster
+
+    bands: list
+           1-based indexes of the bands to sample, all of them if None
+
+    method: string
+            'nearest' for the value of the pixel containing each point, as
+            `DatasetReader.sample`, or 'bilinear' to interpolate between the
+            centers of the four closest pixels (pixels past the edge of the
+            raster take the value of the edge)
+
+    cache: Boolean
+           keep the windows read in memory, up to `cache_bytes`, for later
+           calls on the same raster (True)
+
+    Returns
+    -------
+
+    pandas DataFrame indexed as `points` with a float column per band,
+    named by the band description or `band_<index>`; points outside the
+    raster and nodata pixels are NaN, and so is a bilinear value next to a
+    nodata pixel
+
+    Examples
+    --------
+
+    >>> elevation = sample('../data/nasadem/nasadem_sd.tif', airbnbs)
+    >>> elevation.columns = ['Elevation']
+    """
+    import pandas
+    from bookfeatures import coordinates
+
+    if method not in methods:
+        raise ValueError('method must be one of %s' % methods)
+
+    with _opened(source) as dataset:
+        bands = tuple(dataset.indexes if bands is None else bands)
+        crs = getattr(points, 'crs', None)
+        if crs is not None and dataset.crs is not None and crs != dataset.crs:
+            points = points.to_crs(dataset.crs)
+        x, y = coordinates(points).T
+        col, row = ~dataset.transform * (x, y)
+        height, width = dataset.height, dataset.width
+        values = numpy.full((len(x), len(bands)), numpy.nan)
+
+        inside = (row >= 0) & (row < height) & (col >= 0) & (col < width)
+        if method == 'nearest':
+            r = numpy.floor(numpy.where(inside, row, 0)).astype(int)
+            c = numpy.floor(numpy.where(inside, col, 0)).astype(int)
+            halo = 0
+        else:
+            # corners around the point among pixel centers, clamped to the edge
+            row, col = numpy.where(inside, row, .5) - .5, numpy.where(inside, col, .5) - .5
+            r = numpy.clip(numpy.floor(row), 0, height - 1).astype(int)
+            c = numpy.clip(numpy.floor(col), 0, width - 1).astype(int)
+            dr = numpy.clip(row - r, 0, 1)[:, None]
+            dc = numpy.clip(col - c, 0, 1)[:, None]
+            r1 = numpy.minimum(r + 1, height - 1)
+            c1 = numpy.minimum(c + 1, width - 1)
+            halo = 1
+
+        rows, cols = _window_shape(dataset)
+        key = (r // rows) * (-(-width // cols)) + c // cols
+        order = numpy.flatnonzero(inside)
+        order = order[numpy.argsort(key[order], kind='stable')]
+        _, starts = numpy.unique(key[order], return_index=True)
+        for chunk in numpy.split(order, starts[1:]):
+            if len(chunk) == 0:
+                continue
+            top, left = r[chunk[0]] // rows * rows, c[chunk[0]] // cols * cols
+            window = _read(dataset, bands, top, left,
+                           min(rows + halo, height - top), min(cols + halo, width - left),
+                           cache)
+            ri, ci = r[chunk] - top, c[chunk] - left
+            if method == 'nearest':
+                values[chunk] = window[:, ri, ci].T
+            else:
+                ri1, ci1 = r1[chunk] - top, c1[chunk] - left
+                a, b = dr[chunk], dc[chunk]
+                values[chunk] = ((1 - a) * (1 - b) * window[:, ri, ci].T
+                                 + (1 - a) * b * window[:, ri, ci1].T
+                                 + a * (1 - b) * window[:, ri1, ci].T
+                                 + a * b * window[:, ri1, ci1].T)
+
+        names = [dataset.descriptions[b - 1] or 'band_%d' % b for b in bands]
+    return pandas.DataFrame(values, columns=names, index=getattr(points, 'index', None))
+
+
+def _zonal_tile(path, band, window, transform, geometries, zones, layers, all_touched,
+                local, opened):
+    """
+    Zones present in a tile with their pixel count, sum, min and max
+
+    Zones of different `layers` may share pixels, so each layer is burned
+    into its own array of zone ids.
+    """
+    import rasterio
+    from rasterio.features import rasterize
+
+    # datasets are not shared between threads, each opens its own
+    if not hasattr(local, 'dataset'):
+        local.dataset = rasterio.open(path)
+        opened.append(local.dataset)
+    values = local.dataset.read(band, window=window, masked=True)
+    mask = numpy.ma.getmaskarray(values)
+    data = values.data
+    results = []
+    for layer in numpy.unique(layers):
+        drawn = layers == layer
+        ids = rasterize(zip(geometries[drawn], zones[drawn] + 1), out_shape=values.shape,
+                        transform=transform,
+                        fill=0, all_touched=all_touched, dtype='int32')
+        valid = (ids > 0) & ~mask
+        present, position = numpy.unique(ids[valid] - 1, return_inverse=True)
+        pixels = data[valid].astype(float)
+        low = numpy.full(len(present), numpy.inf)
+        high = numpy.full(len(present), -numpy.inf)
+        numpy.minimum.at(low, position, pixels)
+        numpy.maximum.at(high, position, pixels)
+        results.append((present, numpy.bincount(position, minlength=len(present)),
+                        numpy.bincount(position, pixels, minlength=len(present)), low, high))
+    # zones are in one layer only, so the layers do not repeat zones
+    return tuple(numpy.concatenate(parts) for parts in zip(*results))
+
+
+def _layers(geometries, tree, all_touched):
+    """
+    Layer of every zone such that zones in a layer share no pixels: zones
+    that overlap (or, with `all_touched`, touch) are put in different layers
+    """
+    import scipy.sparse
+    import shapely
+
+    a, b = tree.query(geometries, predicate='intersects')
+    keep = a != b
+    a, b = a[keep], b[keep]
+    if not all_touched and len(a):
+        # pixels are counted by their center, so shared edges are no conflict
+        keep = ~shapely.touches(geometries[a], geometries[b])
+        a, b = a[keep], b[keep]
+    layers = numpy.zeros(len(geometries), dtype=int)
+    if not len(a):
+        return layers
+    links = scipy.sparse.csr_matrix((numpy.ones(len(a)), (a, b)),
+                                    shape=(len(geometries),) * 2)
+    # greedy coloring, in order, of the zones with conflicts only
+    for zone in numpy.unique(a):
+        neighbors = links.indices[links.indptr[zone]:links.indptr[zone + 1]]
+        used = set(layers[neighbors[neighbors < zone]].tolist())
+        layers[zone] = min(set(range(len(used) + 1)) - used)
+    return layers
+
+
+def zonal_stats(source, polygons, band=1, stats=('count', 'sum', 'mean', 'min', 'max'),
+                all_touched=False, workers=4):
+    """
+    Summaries of the pixels of a raster within every polygon
+
+    The raster is streamed window by window: in each window, the polygons
+    that reach it are burned into an array of zone ids, and the counts, sums
+    and extremes of the valid pixels are added to the running totals of their
+    zone. Polygons that overlap are burned in separate layers, so every
+    pixel counts in each zone it belongs to, as in `rasterstats`. Windows are
+    processed in a pool of threads, and memory holds a few windows plus a
+    handful of values per polygon, regardless of the size of the raster.
+
+    Parameters
+    ----------
+
+    source: string, rasterio dataset
+            path to the raster or dataset opened from a file
+
+    polygons: GeoDataFrame, GeoSeries
+              zones to summarize, reprojected to the CRS of the raster if
+              needed; they may overlap
+
+    band: int
+          1-based index of the band to summarize
+
+    stats: list
+           summaries to compute, out of `zonal_statistics`
+
+    all_touched: Boolean
+                 include every pixel touched by a polygon (True) or only
+                 those whose center is inside it (False), as
+                 `rasterstats.zonal_stats`
+
+    workers: int
+             threads reading and rasterizing windows
+
+    Returns
+    -------
+
+    pandas DataFrame indexed as `polygons` with a column per statistic;
+    zones without valid pixels have a count of 0 and NaN summaries
+
+    Examples
+    --------
+
+    >>> elevations = zonal_stats('../data/nasadem/nasadem_sd.tif', sd_tracts)
+    >>> sd_tracts.assign(elevation=elevations['mean']).plot('elevation')
+    """
+    import concurrent.futures
+
+    import pandas
+    import shapely
+    from rasterio.windows import Window, transform
+
+    unknown = set(stats) - set(zonal_statistics)
+    if unknown:
+        raise ValueError('unknown statistics: %s' % sorted(unknown))
+
+    with _opened(source) as dataset:
+        path = dataset.name
+        if polygons.crs is not None and dataset.crs is not None and polygons.crs != dataset.crs:
+            polygons = polygons.to_crs(dataset.crs)
+        geometries = polygons.geometry.values
+        tree = shapely.STRtree(geometries)
+        layers = _layers(geometries, tree, all_touched)
+        rows, cols = _window_shape(dataset)
+        tiles = []
+        for row in range(0, dataset.height, rows):
+            for col in range(0, dataset.width, cols):
+                window = Window(col, row, min(cols, dataset.width - col),
+                                min(rows, dataset.height - row))
+                bounds = shapely.box(*dataset.window_bounds(window))
+                zones = tree.query(bounds, predicate='intersects')
+                if len(zones):
+                    tiles.append((window, transform(window, dataset.transform), zones))
+
+    n = len(geometries)
+    count, total = numpy.zeros((2, n))
+    low = numpy.full(n, numpy.inf)
+    high = numpy.full(n, -numpy.inf)
+    local, opened = threading.local(), []
+    try:
+        with concurrent.futures.ThreadPoolExecutor(workers) as pool:
+            futures = [pool.submit(_zonal_tile, path, band, window, affine,
+                                   geometries[zones], zones, layers[zones], all_touched,
+                                   local, opened)
+                       for window, affine, zones in tiles]
+            for future in concurrent.futures.as_completed(futures):
+                present, c, s, a, b = future.result()
+                count[present] += c
+                total[present] += s
+                low[present] = numpy.minimum(low[present], a)
+                high[present] = numpy.maximum(high[present], b)
+    finally:
+        for dataset in opened:
+            dataset.close()
+
+    empty = count == 0
+    with numpy.errstate(divide='ignore', invalid='ignore'):
+        summaries = {'count': count.astype(int),
+                     'sum': numpy.where(empty, numpy.nan, total),
+                     'mean': total / count,
+                     'min': numpy.where(empty, numpy.nan, low),
+                     'max': numpy.where(empty, numpy.nan, high)}
+    return pandas.DataFrame({stat: summaries[stat] for stat in stats},
+                            index=polygons.index)
@@ -0,0 +1,224 @@
+import numpy
+
+
+# linear models on tables too large to hold in memory
+#
+# Least squares only needs the cross-products of the variables. They are
+# accumulated chunk by chunk from the source into one Gram matrix of the
+# constant, every variable and every spatial lag, and each specification
+# (OLS, SLX, or the two-stage least squares spatial lag of `spreg.GM_Lag`)
+# is solved from its blocks. Lags are computed once, for all columns, with
+# one sparse product.
+
+# rows read at once from a file
+chunk_size = 10 ** 6
+
+CONSTANT = 'CONSTANT'
+
+
+def lag(w, values):
+    """
+    Spatial lag of many columns at once, as `lag_spatial` column by column
+
+    Parameters
+    ----------
+
+    w: libpysal W
+       weights, with the transformation they should be applied with
+
+    values: DataFrame, array
+            (n, p) values
+
+    Returns
+    -------
+
+    pandas DataFrame of `w_<column>` lags indexed as `values`, or an (n, p)
+    array for an array
+    """
+    import pandas
+    from bookesda import sparse_weights
+
+    lagged = sparse_weights(w) @ numpy.asarray(values, dtype=float)
+    if isinstance(values, pandas.DataFrame):
+        return pandas.DataFrame(lagged, index=values.index,
+                                columns=['w_' + str(c) for c in values.columns])
+    return lagged
+
+
+def _chunks(source, columns, chunksize=None):
+    """
+    Stream of DataFrames with `columns`, in that order, out of a table, a
+    Parquet file or any file pyogrio reads (GeoJSON, GeoPackage...), in row
+    order
+    """
+    import pandas
+
+    chunksize = chunksize or chunk_size
+    if isinstance(source, pandas.DataFrame):
+        for start in range(0, len(source), chunksize):
+            yield source[columns].iloc[start:start + chunksize]
+    elif str(source).endswith('.parquet'):
+        import pyarrow.parquet
+
+        for batch in pyarrow.parquet.ParquetFile(source).iter_batches(chunksize, columns=columns):
+            yield batch.to_pandas()[columns]
+    else:
+        import pyogrio
+
+        rows = pyogrio.read_info(source)['features']
+        for start in range(0, rows, chunksize):
+            yield pyogrio.read_dataframe(source, columns=columns, read_geometry=False,
+                                         skip_features=start, max_features=chunksize)[columns]
+
+
+def cross_products(source, columns, w=None, lagged=(), chunksize=None):
+    """
+    Gram matrix of a constant, columns of a table and their spatial lags
+
+    Parameters
+    ----------
+
+    source: DataFrame, string
+            table, or path to a Parquet or vector file read in chunks
+
+    columns: list
+             variables, dependent and explanatory
+
+    w: libpysal W
+       weights for the lags, with rows in the order of `source`
+
+    lagged: list
+            columns to lag, as `w_<column>`; only these are held in memory
+            whole, as a spatial lag needs all rows
+
+    chunksize: int
+               rows read at once, `chunk_size` if None
+
+    Returns
+    -------
+
+    products: pandas DataFrame with the sums of cross-products of
+              `CONSTANT`, `columns` and the lags, by name
+
+    n: int
+       number of rows
+    """
+    import pandas
+
+    columns, lagged = list(columns), list(lagged)
+    lags = numpy.empty((0, 0))
+    if lagged:
+        whole = pandas.concat(list(_chunks(source, lagged, chunksize)))
+        lags = lag(w, whole.to_numpy(dtype=float))
+    names = [CONSTANT] + columns + ['w_' + c for c in lagged]
+    products = numpy.zeros((len(names), len(names)))
+    n = 0
+    for chunk in _chunks(source, columns, chunksize):
+        m = len(chunk)
+        z = numpy.hstack([numpy.ones((m, 1)), chunk.to_numpy(dtype=float), lags[n:n + m]])
+        products += z.T @ z
+        n += m
+    return pandas.DataFrame(products, index=names, columns=names), n
+
+
+def _ols(products, n, y, x):
+    from scipy import stats
+
+    xx = products.loc[x, x].to_numpy()
+    xy = products.loc[x, y].to_numpy()
+    beta = numpy.linalg.solve(xx, xy)
+    k = len(x)
+    residuals = products.loc[y, y] - beta @ xy
+    sigma2 = residuals / (n - k)
+    std_err = numpy.sqrt(numpy.diag(numpy.linalg.inv(xx)) * sigma2)
+    t = beta / std_err
+    total = products.loc[y, y] - products.loc[y, CONSTANT] ** 2 / n
+    r2 = 1 - residuals / total
+    return (beta, std_err, t, 2 * stats.t.sf(numpy.abs(t), n - k),
+            {'n': n, 'k': k, 'r2': r2, 'adj_r2': 1 - (1 - r2) * (n - 1) / (n - k),
+             'sigma2': sigma2})
+
+
+def _tsls(products, n, y, z, h):
+    from scipy import stats
+
+    hh = numpy.linalg.inv(products.loc[h, h].to_numpy())
+    hz = products.loc[h, z].to_numpy()
+    hy = products.loc[h, y].to_numpy()
+    zhhz = hz.T @ hh @ hz
+    beta = numpy.linalg.solve(zhhz, hz.T @ hh @ hy)
+    zy = products.loc[z, y].to_numpy()
+    zz = products.loc[z, z].to_numpy()
+    # u'u and the fitted values, from cross-products only
+    residuals = products.loc[y, y] - 2 * beta @ zy + beta @ zz @ beta
+    sigma2 = residuals / n
+    std_err = numpy.sqrt(numpy.diag(numpy.linalg.inv(zhhz)) * sigma2)
+    statistic = beta / std_err
+    ybar = products.loc[y, CONSTANT] / n
+    fitted = beta @ products.loc[z, CONSTANT].to_numpy() / n
+    covariance = beta @ zy / n - ybar * fitted
+    variances = (products.loc[y, y] / n - ybar ** 2, beta @ zz @ beta / n - fitted ** 2)
+    return (beta, std_err, statistic, 2 * stats.norm.sf(numpy.abs(statistic)),
+            {'n': n, 'k': len(z), 'pseudo_r2': covariance ** 2 / numpy.prod(variances),
+             'sigma2': sigma2})
+
+
+def fit(products, n, specs):
+    """
+    Estimate many linear specifications from shared cross-products
+
+    Parameters
+    ----------
+
+    products: DataFrame
+              cross-products from `cross_products`
+
+    n: int
+       number of rows
+
+    specs: dict
+           name -> (y, x) for OLS, with a constant added as in `spreg.OLS`,
+           or name -> (y, x, endogenous, instruments) for two stage least
+           squares as `spreg.TSLS`; the spatial lag model of `spreg.GM_Lag`
+           is `(y, x, ['w_' + y], ['w_' + c for c in x])`
+
+    Returns
+    -------
+
+    coefficients: pandas DataFrame indexed by spec and variable with the
+                  estimate, `std_err`, `t` (z for two stages) and `p`
+                  values
+
+    summary: pandas DataFrame indexed by spec with `n`, `k`, `r2` and
+             `adj_r2` (OLS) or `pseudo_r2` (two stages) and `sigma2`
+
+    Examples
+    --------
+
+    >>> products, n = cross_products(db, ['log_price'] + variable_names,
+    ...                              w=knn, lagged=['log_price'] + variable_names)
+    >>> coefficients, summary = fit(products, n, {
+    ...     'ols': ('log_price', variable_names),
+    ...     'slx': ('log_price', variable_names + ['w_' + c for c in variable_names]),
+    ...     'lag': ('log_price', variable_names, ['w_log_price'],
+    ...             ['w_' + c for c in variable_names])})
+    """
+    import pandas
+
+    tables, rows = {}, {}
+    for name, spec in specs.items():
+        if len(spec) == 2:
+            y, x = spec
+            variables = [CONSTANT] + list(x)
+            beta, std_err, t, p, rows[name] = _ols(products, n, y, variables)
+        else:
+            y, x, endogenous, instruments = spec
+            variables = [CONSTANT] + list(x) + list(endogenous)
+            beta, std_err, t, p, rows[name] = _tsls(
+                products, n, y, variables, [CONSTANT] + list(x) + list(instruments))
+        tables[name] = pandas.DataFrame({'estimate': beta, 'std_err': std_err, 't': t, 'p': p},
+                                        index=pandas.Index(variables, name='variable'))
+    coefficients = pandas.concat(tables, names=['spec'])
+    summary = pandas.DataFrame.from_dict(rows, orient='index')
+    summary.index.name = 'spec'
+    return coefficients, summary
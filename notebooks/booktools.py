@@ -1,17 +1,314 @@
-from pysal.viz import mapclassify
+import hashlib
+import importlib
+import os
+from collections import OrderedDict
 
 
-# facade for geopandas and pysal2.0rc
+# facade for geopandas and mapclassify
 
-schemes = ['Quantiles', 'Equal_Interval', 'Maximum_Breaks', 'Fisher_Jenks']
-dispatcher = {}
-for scheme in schemes:
-    dispatcher[scheme.lower()] = eval('mapclassify.classifiers.{scheme}'.format(scheme=scheme))
+schemes = ['Quantiles', 'Equal_Interval', 'Maximum_Breaks', 'Fisher_Jenks',
+           'Jenks_Caspall', 'HeadTailBreaks', 'BoxPlot', 'Std_Mean', 'UserDefined',
+           'MaxP']
 
-def choropleth(df, column, scheme='Quantiles', k=5, cmap='BluGrn', legend=False,  \
-               edgecolor='white', linewidth=0.1, alpha=0.75, ax=None):
+# optimal schemes that are fit on a random sample of large inputs
+sampled_schemes = ['Fisher_Jenks', 'Jenks_Caspall']
+sample_threshold = 10000
+
+# with levels of detail, geometries are drawn simplified by at most this many
+# pixels of the output, which is not visible
+lod_pixels = 0.5
+
+# classifier classes, resolved from mapclassify on first use
+_registry = {}
+
+# recent classifications keyed by (scheme, k, hash of the values)
+_classified = OrderedDict()
+_classified_size = 128
+
+
+# names used by older mapclassify releases
+_aliases = {'maxpclassifier': 'maxp'}
+
+
+def _key(scheme):
+    # mapclassify has spelled these both Equal_Interval and EqualInterval
+    key = scheme.lower().replace('_', '')
+    return _aliases.get(key, key)
+
+
+def classifier(scheme):
     """
-    Choropleth mapping based on geopandas and pysal2.0rc
+    mapclassify class implementing a classification scheme
+
+    Parameters
+    ----------
+
+    scheme: string
+            Name of the scheme, case and underscores ignored ('Fisher_Jenks',
+            'fisherjenks' and 'FisherJenks' are equivalent)
+
+    Returns
+    -------
+
+    mapclassify classifier class
+
+    """
+    key = _key(scheme)
+    if key not in _registry:
+        if key not in {_key(s) for s in schemes}:
+            raise ValueError('Unknown classification scheme: %r' % scheme)
+        mapclassify = importlib.import_module('mapclassify')
+        _registry[key] = next(getattr(mapclassify, name) for name in dir(mapclassify)
+                              if _key(name) == key)
+    return _registry[key]
+
+
+def __getattr__(name):
+    # keep `booktools.dispatcher` and `booktools.mapclassify` working without
+    # paying for the import until somebody asks
+    if name == 'dispatcher':
+        return {scheme.lower(): classifier(scheme) for scheme in schemes}
+    if name == 'mapclassify':
+        return importlib.import_module('mapclassify')
+    raise AttributeError('module %r has no attribute %r' % (__name__, name))
+
+
+def import_benchmark(module='booktools', repeat=5):
+    """
+    Time the import of a module in fresh interpreters
+
+    Parameters
+    ----------
+
+    module: string
+            name of the module to import, looked up next to this file first
+
+    repeat: int
+            number of interpreters to start
+
+    Returns
+    -------
+
+    list of import times in seconds, one per interpreter
+
+    """
+    import subprocess
+    import sys
+
+    code = ('import time; t = time.perf_counter(); import {module}; '
+            'print(time.perf_counter() - t)').format(module=module)
+    here = os.path.abspath(os.path.dirname(__file__))
+    timings = []
+    for _ in range(repeat):
+        out = subprocess.run([sys.executable, '-c', code], cwd=here, check=True,
+                             capture_output=True, text=True)
+        timings.append(float(out.stdout.strip().splitlines()[-1]))
+    return timings
+
+
+def _sampled(cls, y, size, seed, **kwds):
+    """
+    Fit `cls` on a random sample of `y` and apply its bins to all of `y`.
+
+    The sample always contains the extremes of `y`. The returned classifier
+    carries `sample_size` and `approximation_error`, the difference between
+    the goodness of absolute deviation fit on the sample and on all values.
+    """
+    import numpy
+    from mapclassify import UserDefined
+
+    rng = numpy.random.default_rng(seed)
+    sample = numpy.concatenate([y[[y.argmin(), y.argmax()]],
+                                rng.choice(y, size=size - 2, replace=False)])
+    fit = cls(sample, **kwds)
+    classified = UserDefined(y, fit.bins)
+    classified.sample_size = size
+    classified.approximation_error = abs(fit.get_gadf() - classified.get_gadf())
+    return classified
+
+
+def classify(values, scheme='Quantiles', k=5, sample_size=None, seed=12345, **kwds):
+    """
+    Classify values with a mapclassify scheme, reusing earlier results
+
+    Parameters
+    ----------
+
+    values: array-like
+            numeric values to classify
+
+    scheme: string
+            Name of mapclassify classification scheme
+
+    k:  int
+        number of classes, ignored by schemes that do not take one
+        (HeadTailBreaks, BoxPlot, Std_Mean, UserDefined)
+
+    sample_size: int
+                 size of the random sample used to fit the schemes in
+                 `sampled_schemes`, by default `sample_threshold`; inputs no
+                 larger than this are classified exactly
+
+    seed: int
+          seed for drawing that sample
+
+    **kwds: dict
+            further arguments to the classifier (e.g. bins for UserDefined,
+            hinge for BoxPlot)
+
+    Returns
+    -------
+
+    mapclassify classifier instance
+
+    Notes
+    -----
+    Fisher-Jenks is quadratic in the number of values. Above the sample
+    size, sampled schemes are fit on a sample that keeps the minimum and
+    maximum, and the resulting bins are applied to every value. The
+    returned classifier then has `sample_size` and `approximation_error`
+    attributes.
+
+    The last `_classified_size` classifications are kept, keyed by the
+    scheme, its arguments and a hash of the values, so drawing the same
+    column again (e.g. in small multiples) does not rerun the classifier.
+    """
+    import inspect
+    import numpy
+
+    y = numpy.ascontiguousarray(values, dtype='float64').ravel()
+    cls = classifier(scheme)
+    if 'k' in inspect.signature(cls).parameters:
+        kwds['k'] = k
+    size = sample_size or sample_threshold
+    sampled = (_key(scheme) in {_key(s) for s in sampled_schemes}
+               and len(y) > size)
+    key = (_key(scheme), repr(sorted(kwds.items())), sampled and (size, seed),
+           y.shape, hashlib.sha1(y).hexdigest())
+    if key in _classified:
+        _classified.move_to_end(key)
+        return _classified[key]
+    if sampled:
+        classified = _sampled(cls, y, size, seed, **kwds)
+    else:
+        classified = cls(y, **kwds)
+    _classified[key] = classified
+    while len(_classified) > _classified_size:
+        _classified.popitem(last=False)
+    return classified
+
+
+def _codes(bins, yb):
+    # classes whose bounds print the same share a label
+    import pandas
+
+    bounds = pandas.Index(['%.3f' % cut for cut in bins])
+    categories = bounds.unique()
+    return categories.get_indexer(bounds)[yb], categories
+
+
+def class_labels(classified, index=None):
+    """
+    Categorical of class labels (upper bounds) for every classified value
+
+    Parameters
+    ----------
+
+    classified: mapclassify classifier instance
+
+    index: pandas Index
+           index for the returned Series
+
+    Returns
+    -------
+
+    pandas Series with a categorical dtype whose categories are the class
+    upper bounds, formatted to three decimals, in ascending order
+
+    """
+    import pandas
+
+    codes, categories = _codes(classified.bins, classified.yb)
+    return pandas.Series(pandas.Categorical.from_codes(codes, categories),
+                         index=index)
+
+
+def _paths(geoms):
+    """
+    One compound matplotlib Path per (Multi)Polygon, built in bulk.
+
+    Rings become MOVETO ... CLOSEPOLY runs. Exteriors are wound
+    counter-clockwise and interiors clockwise so that matplotlib's nonzero
+    fill leaves holes empty whatever the orientation in the source. Other
+    geometry types get an empty path.
+    """
+    import numpy
+    import shapely
+    from matplotlib.path import Path
+
+    geoms = numpy.asarray(geoms, dtype=object)
+    parts, part_owner = shapely.get_parts(geoms, return_index=True)
+    rings, ring_part = shapely.get_rings(parts, return_index=True)
+    coords, coord_ring = shapely.get_coordinates(rings, return_index=True)
+    starts = numpy.searchsorted(coord_ring, numpy.arange(len(rings) + 1))
+
+    if len(coords):
+        # twice the signed area of each ring (shoelace), positive if ccw
+        x, y = coords[:, 0], coords[:, 1]
+        cross = numpy.append(x[:-1] * y[1:] - x[1:] * y[:-1], 0)
+        cross[starts[1:] - 1] = 0
+        area = numpy.add.reduceat(cross, starts[:-1])
+        exterior = numpy.r_[True, ring_part[1:] != ring_part[:-1]]
+        flip = (area > 0) != exterior
+        order = numpy.arange(len(coords))
+        mirrored = starts[coord_ring] + starts[coord_ring + 1] - 1 - order
+        coords = coords[numpy.where(flip[coord_ring], mirrored, order)]
+
+    codes = numpy.full(len(coords), Path.LINETO, dtype=Path.code_type)
+    codes[starts[:-1]] = Path.MOVETO
+    codes[starts[1:] - 1] = Path.CLOSEPOLY
+
+    coord_owner = part_owner[ring_part[coord_ring]]
+    cuts = numpy.searchsorted(coord_owner, numpy.arange(len(geoms) + 1))
+    return [Path(coords[a:b], codes[a:b]) for a, b in zip(cuts[:-1], cuts[1:])]
+
+
+def _pixel(df, ax, dpi=None):
+    """
+    Size of a pixel of `ax`, at `dpi` (the larger of the figure and savefig
+    resolutions by default), in the units of `df` drawn to fill it.
+
+    Geographic coordinates are stretched by 1 / cos(latitude), as geopandas
+    does, and the pixel is measured along the axis with the finer scale.
+    """
+    import numpy
+    from matplotlib import rcParams
+
+    figure = ax.get_figure()
+    if dpi is None:
+        saved = rcParams['savefig.dpi']
+        dpi = max(figure.dpi, figure.dpi if saved == 'figure' else saved)
+    box = ax.get_window_extent()
+    width, height = box.width / figure.dpi * dpi, box.height / figure.dpi * dpi
+    minx, miny, maxx, maxy = df.total_bounds
+    aspect = 1
+    if df.crs is not None and df.crs.is_geographic:
+        aspect = 1 / numpy.cos(numpy.radians((miny + maxy) / 2))
+    return max((maxx - minx) / width, (maxy - miny) * aspect / height) / max(aspect, 1)
+
+
+def _detailed(df, pixel):
+    # `df` with the coarsest geometries that look the same at that pixel size
+    from bookdata import level_of_detail
+
+    return df.set_geometry(level_of_detail(df, lod_pixels * pixel))
+
+
+def choropleth(df, column, scheme='Quantiles', k=5, cmap='BuGn', legend=False,  \
+               edgecolor='white', linewidth=0.1, alpha=0.75, ax=None, classified=None,
+               classification_kwds=None, lod=False, dpi=None):
+    """
+    Choropleth mapping based on geopandas and mapclassify
     
     Parameters
     ----------
@@ -43,15 +340,161 @@ def choropleth(df, column, scheme='Quantiles', k=5, cmap='BluGrn', legend=False,
            transparency
             
     ax: matplotlib.pyplot plt axis
+
+    classified: mapclassify classifier instance
+                precomputed classification of `column`; `scheme` and `k`
+                are ignored when given
+
+    classification_kwds: dict
+                         further arguments for `classify` (e.g. bins for
+                         UserDefined, sample_size for Fisher_Jenks)
+
+    lod: Boolean
+         draw the coarsest cached level of detail of the geometries that is
+         visually lossless on `ax` (True), see `bookdata.level_of_detail`
+
+    dpi: int
+         resolution the map is shown or saved at, for `lod`; the larger of
+         the figure and savefig resolutions by default
     
     
     """
-    classified = dispatcher[scheme.lower()](df[column], k=k)
-    legend = [ '%.3f'%cut  for cut in classified.bins]
-    labels = [legend[ybi] for ybi in classified.yb]
-    ax = df.assign(cl=labels).plot(column='cl', categorical=True, \
-                                   cmap=cmap, legend=legend, 
-                                   edgecolor=edgecolor, linewidth=linewidth, \
-                                   alpha=alpha, ax=ax)
+    if classified is None:
+        classified = classify(df[column], scheme=scheme, k=k,
+                              **(classification_kwds or {}))
+    labels = class_labels(classified, index=df.index)
+    if lod:
+        import matplotlib.pyplot as plt
+
+        if ax is None:
+            _, ax = plt.subplots()
+        df = _detailed(df, _pixel(df, ax, dpi))
+    ax = df.plot(column=labels, categorical=True, \
+                 cmap=cmap, legend=legend, 
+                 edgecolor=edgecolor, linewidth=linewidth, \
+                 alpha=alpha, ax=ax)
     return ax
-    
+
+
+def choropleth_grid(df, columns, scheme='Quantiles', k=5, cmap='BuGn', shared=False,
+                    legend=False, edgecolor='white', linewidth=0.1, alpha=0.75,
+                    ncols=None, figsize=None, axes=None, classification_kwds=None,
+                    lod=False, dpi=None):
+    """
+    Small multiple choropleths of several columns sharing one geometry
+
+    Parameters
+    ----------
+
+    df: geopandas GeoDataFrame
+        with (Multi)Polygon geometries
+
+    columns: list
+             column names for the attributes to be mapped, one panel each
+
+    scheme: string
+            Name of mapclassify classification scheme
+
+    k:  int
+        number of classes for each choropleth
+
+    cmap: string
+          name of colormap from matplotlib
+
+    shared: Boolean
+            classify the values of all columns together and use the same
+            classes in every panel (True)
+
+    legend: Boolean
+            Show a legend in every panel (True)
+
+    edgecolor: string
+             Color of polygon edges
+
+    linewidth: float
+            width of edges
+
+    alpha: float
+           transparency
+
+    ncols: int
+           number of panel columns, defaults to a near-square grid
+
+    figsize: tuple
+             figure size when `axes` is not given
+
+    axes: sequence of matplotlib axes
+          at least len(columns) axes to draw into; a new figure is made
+          otherwise
+
+    classification_kwds: dict
+                         further arguments for `classify` (e.g. bins for
+                         UserDefined, sample_size for Fisher_Jenks)
+
+    lod: Boolean
+         draw the coarsest cached level of detail of the geometries that is
+         visually lossless on the panels (True)
+
+    dpi: int
+         resolution the panels are shown or saved at, for `lod`
+
+    Returns
+    -------
+
+    numpy array of the axes drawn into
+
+    Notes
+    -----
+    Geometries are converted to matplotlib paths once and every panel only
+    gets a new set of face colors, so the cost of extra panels is the
+    classification and color lookup rather than geometry processing.
+    """
+    import matplotlib.pyplot as plt
+    import numpy
+    from matplotlib.collections import PathCollection
+    from matplotlib.patches import Patch
+
+    if axes is None:
+        ncols = ncols or int(numpy.ceil(numpy.sqrt(len(columns))))
+        nrows = int(numpy.ceil(len(columns) / ncols))
+        _, axes = plt.subplots(nrows, ncols, figsize=figsize, squeeze=False)
+    axes = numpy.asarray(axes).ravel()
+
+    if lod:
+        # the largest panel needs the most detail
+        pixel = min(_pixel(df, ax, dpi) for ax in axes[:len(columns)])
+        paths = _paths(_detailed(df, pixel).geometry.values)
+    else:
+        paths = _paths(df.geometry.values)
+    minx, miny, maxx, maxy = df.total_bounds
+    colormap = plt.get_cmap(cmap)
+    classification_kwds = classification_kwds or {}
+    if shared:
+        pooled = classify(numpy.concatenate([df[c].values for c in columns]),
+                          scheme=scheme, k=k, **classification_kwds)
+        bins = pooled.bins
+
+    for ax, column in zip(axes, columns):
+        values = df[column].values
+        if shared:
+            yb = numpy.searchsorted(bins, values, side='left').clip(max=len(bins) - 1)
+            codes, categories = _codes(bins, yb)
+        else:
+            classified = classify(values, scheme=scheme, k=k, **classification_kwds)
+            codes, categories = _codes(classified.bins, classified.yb)
+        palette = colormap(numpy.arange(len(categories)) / max(len(categories) - 1, 1))
+        ax.add_collection(PathCollection(paths, facecolors=palette[codes],
+                                         edgecolors=edgecolor,
+                                         linewidths=linewidth, alpha=alpha))
+        ax.set_xlim(minx, maxx)
+        ax.set_ylim(miny, maxy)
+        ax.set_aspect('equal')
+        ax.set_title(column)
+        ax.set_axis_off()
+        if legend:
+            ax.legend(handles=[Patch(facecolor=color, edgecolor=edgecolor, alpha=alpha,
+                                     label=label)
+                               for color, label in zip(palette, categories)])
+    for ax in axes[len(columns):]:
+        ax.set_axis_off()
+    return axes
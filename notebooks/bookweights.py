@@ -0,0 +1,92 @@
+import os
+
+import bookdata
+
+
+# spatial weights cached on disk by a fingerprint of the geometries
+#
+# Building contiguity or distance weights is the same work every time a
+# notebook runs on an unchanged table. Weights are stored as CSR matrices
+# (`.npz`) under `cachepath`, named by a hash of the geometries (WKB), their
+# CRS, the row ids, the builder and its parameters, and libpysal's version
+# (see `bookdata.fingerprint` and `bookdata.cached_matrix`).
+
+cachepath = os.path.join(bookdata.cachepath, 'weights')
+
+# builder name -> libpysal.weights class and whether it labels with the index
+# by default, as in libpysal
+builders = {'queen': ('Queen', False),
+            'rook': ('Rook', False),
+            'knn': ('KNN', True),
+            'distance_band': ('DistanceBand', True),
+            'kernel': ('Kernel', True)}
+
+
+def weights(gdf, builder='queen', use_index=None, refresh=False, **kwds):
+    """
+    Spatial weights for a GeoDataFrame, from the cache when possible
+
+    Parameters
+    ----------
+
+    gdf: geopandas GeoDataFrame
+         table to build the weights for
+
+    builder: string
+             one of `builders` ('queen', 'rook', 'knn', 'distance_band',
+             'kernel')
+
+    use_index: Boolean
+               label observations with the index of `gdf` (True) or their
+               position (False); libpysal's default for the builder if None
+
+    refresh: Boolean
+             build the weights again even if they are cached (True)
+
+    **kwds: parameters of the libpysal builder, e.g. `k` for 'knn' or
+            `threshold` for 'distance_band'
+
+    Returns
+    -------
+
+    libpysal W, untransformed; attributes specific to a class (such as the
+    bandwidth of Kernel weights) are not kept
+
+    Examples
+    --------
+
+    >>> wq = weights(pci_df, 'queen')
+    >>> wk = weights(db, 'knn', k=8)
+    """
+    import libpysal
+
+    name, labelled = builders[builder]
+    labelled = labelled if use_index is None else use_index
+    key = bookdata.fingerprint(gdf, builder, sorted(kwds.items()), libpysal.__version__,
+                               gdf.index.tolist())
+    path = os.path.join(cachepath, '%s-%s.npz' % (builder, key[:16]))
+
+    def build():
+        cls = getattr(libpysal.weights, name)
+        return cls.from_dataframe(gdf.reset_index(drop=True), use_index=False, **kwds).sparse
+
+    matrix = bookdata.cached_matrix(path, build, refresh)
+
+    ids = gdf.index.tolist() if labelled else list(range(len(gdf)))
+    return libpysal.weights.WSP(matrix, id_order=ids).to_W(silence_warnings=True)
+
+
+def queen(gdf, **kwds):
+    return weights(gdf, 'queen', **kwds)
+
+def rook(gdf, **kwds):
+    return weights(gdf, 'rook', **kwds)
+
+def knn(gdf, k=2, **kwds):
+    return weights(gdf, 'knn', k=k, **kwds)
+
+def distance_band(gdf, threshold, **kwds):
+    return weights(gdf, 'distance_band', threshold=threshold, **kwds)
+
+def kernel(gdf, **kwds):
+    return weights(gdf, 'kernel', **kwds)